@@ -0,0 +1,29 @@
+#!/bin/bash
+set -e
+
+# Wait for the first member to accept connections
+until mongosh --host mongo-rs1 --quiet --eval "db.adminCommand('ping')" > /dev/null 2>&1; do
+  sleep 1
+done
+
+mongosh --host mongo-rs1 --quiet <<EOS
+try {
+  rs.status()
+  print("Replica set rs0 already initiated")
+} catch (e) {
+  rs.initiate({
+    _id: "rs0",
+    members: [
+      { _id: 0, host: "mongo-rs1:27017", priority: 2 },
+      { _id: 1, host: "mongo-rs2:27017" },
+      { _id: 2, host: "mongo-rs3:27017" }
+    ]
+  })
+  print("Replica set rs0 initiated")
+}
+EOS
+
+# Only exit once there is a primary, so the app can seed and index straight away
+until mongosh --host mongo-rs1 --quiet --eval "quit(db.hello().isWritablePrimary ? 0 : 1)" > /dev/null 2>&1; do
+  sleep 1
+done
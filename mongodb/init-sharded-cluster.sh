@@ -0,0 +1,71 @@
+#!/bin/bash
+set -e
+
+# Sets up the "sharded" compose profile: one config server, two single-member
+# shard replica sets and a mongos. sandwich_prices is sharded on
+# { borough: 1, geohash: 1 } with one zone per borough. The zones are defined
+# before the collection is sharded so it starts out split at borough boundaries.
+
+wait_for() {
+  until mongosh --host "$1" --quiet --eval "db.adminCommand('ping')" > /dev/null 2>&1; do
+    sleep 1
+  done
+}
+
+initiate() {
+  mongosh --host "$1" --quiet <<EOS
+try {
+  rs.status()
+} catch (e) {
+  rs.initiate({ _id: "$2", configsvr: $3, members: [{ _id: 0, host: "$1" }] })
+  print("Replica set $2 initiated")
+}
+EOS
+}
+
+wait_for mongo-cfg:27019
+initiate mongo-cfg:27019 cfg true
+wait_for mongo-shard1:27018
+initiate mongo-shard1:27018 shard1 false
+wait_for mongo-shard2:27018
+initiate mongo-shard2:27018 shard2 false
+
+wait_for mongos:27017
+mongosh --host mongos:27017 --quiet <<'EOS'
+const ns = "sandwich_db.sandwich_prices"
+// Roughly even share of prices per shard
+const zones = {
+  "Manhattan": "shard1",
+  "Bronx": "shard1",
+  "Staten Island": "shard1",
+  "Brooklyn": "shard2",
+  "Queens": "shard2"
+}
+
+// addShard waits for the shard's replica set to elect a primary
+for (const shard of ["shard1/mongo-shard1:27018", "shard2/mongo-shard2:27018"]) {
+  while (true) {
+    try {
+      sh.addShard(shard)
+      break
+    } catch (e) {
+      sleep(1000)
+    }
+  }
+}
+
+if (db.getSiblingDB("config").collections.findOne({ _id: ns })) {
+  print(ns + " is already sharded")
+  quit()
+}
+
+sh.enableSharding("sandwich_db")
+for (const [borough, shard] of Object.entries(zones)) {
+  sh.addShardToZone(shard, borough)
+  sh.updateZoneKeyRange(ns, { borough: borough, geohash: MinKey },
+                        { borough: borough, geohash: MaxKey }, borough)
+}
+db.getSiblingDB("sandwich_db").sandwich_prices.createIndex({ borough: 1, geohash: 1 })
+sh.shardCollection(ns, { borough: 1, geohash: 1 })
+print(ns + " sharded with zones per borough")
+EOS
@@ -0,0 +1,205 @@
+"""Admission control for the expensive routes of the NYC Sandwich Price Tracker.
+
+Each limited route gets a cap on how many requests it serves at once, a per-client
+token bucket, and a queue-time budget. Requests that would wait longer than the
+budget for a slot are shed with 503, and clients that run out of tokens get 429,
+both with a Retry-After header, so cheap routes keep working during spikes.
+"""
+import functools
+import logging
+import math
+import threading
+import time
+
+from flask import jsonify, make_response, request
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryRateLimitStore:
+    """Token buckets kept in this process, which is enough for a single worker."""
+
+    def __init__(self, clock=time.monotonic, max_keys=10000):
+        self._clock = clock
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst):
+        """Take one token from a bucket.
+
+        Returns (allowed, retry_after) where retry_after is the number of seconds
+        until a token will be available again.
+        """
+        now = self._clock()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # Routes have different rates, so each bucket remembers when it will
+            # be full again and can be forgotten
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+
+            if len(self._buckets) > self._max_keys:
+                self._prune(now)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def _prune(self, now):
+        """Forget buckets that have been idle long enough to be full again."""
+        for key, (_, _, full_at) in list(self._buckets.items()):
+            if now >= full_at:
+                del self._buckets[key]
+
+
+class MongoRateLimitStore:
+    """Token buckets shared by every worker through a MongoDB collection.
+
+    Each take is a single atomic upsert that refills the bucket using the server's
+    clock, so workers never need to agree on the time.
+    """
+
+    def __init__(self, get_collection):
+        self._get_collection = get_collection
+
+    def ensure_indexes(self):
+        """Let MongoDB drop buckets that have not been touched for an hour."""
+        self._get_collection().create_index("updated", expireAfterSeconds=3600)
+
+    def take(self, key, rate, burst):
+        """Take one token from a bucket, see MemoryRateLimitStore.take."""
+        elapsed_s = {"$divide": [
+            {"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]}, 1000
+        ]}
+        bucket = self._get_collection().find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [burst, {"$add": [
+                        {"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed_s, rate]}
+                    ]}]},
+                    "updated": "$$NOW"
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": [
+                    "$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"
+                ]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        allowed = bucket["allowed"]
+        return allowed, 0 if allowed else (1 - bucket["tokens"]) / rate
+
+
+def upstream_queue_time():
+    """Seconds the request already spent queued in front of the app.
+
+    Reads the X-Request-Start header set by proxies such as nginx or Heroku's
+    router ("t=<timestamp>" in seconds, milliseconds or microseconds).
+    """
+    header = request.headers.get("X-Request-Start", "")
+    try:
+        started = float(header.removeprefix("t="))
+    except ValueError:
+        return 0
+
+    now = time.time()
+    # Work out the unit from the magnitude of the timestamp
+    for scale in (1, 1e3, 1e6):
+        if started / scale < now * 10:
+            return max(0, now - started / scale)
+    return 0
+
+
+def client_address(trusted_proxies=0):
+    """IP address of the client, seen through `trusted_proxies` reverse proxies.
+
+    Every proxy appends the address it got the request from to X-Forwarded-For, so
+    the client is the entry that many places from the end. Anything before it was
+    sent by the client and cannot be trusted.
+    """
+    if trusted_proxies:
+        forwarded = [address.strip()
+                     for address in request.headers.get("X-Forwarded-For", "").split(",")
+                     if address.strip()]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+    return request.remote_addr
+
+
+class AdmissionController:
+    """Hand out route decorators that enforce concurrency and rate limits.
+
+    Behind a load balancer every request comes from the balancer's address, so
+    `trusted_proxies` must be set to the number of proxies in front of the app for
+    rate limits to apply per client.
+    """
+
+    def __init__(self, store, enabled=True, trusted_proxies=0):
+        self.store = store
+        self.enabled = enabled
+        self.trusted_proxies = trusted_proxies
+
+    def limit(self, name, concurrency, rate, burst, queue_budget, retry_after=1):
+        """Limit a route.
+
+        `concurrency` requests are served at once and others wait at most
+        `queue_budget` seconds (including time spent queued upstream) for a slot.
+        Each client may make `rate` requests per second with bursts of `burst`.
+        """
+        slots = threading.BoundedSemaphore(concurrency)
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+
+                client = client_address(self.trusted_proxies)
+                try:
+                    allowed, wait = self.store.take(f"{name}:{client}", rate, burst)
+                except PyMongoError as e:
+                    # Better to serve without rate limits than to fail every request
+                    logger.error("Could not check the %s rate limit: %s", name, str(e))
+                    allowed = True
+                if not allowed:
+                    return reject(429, "Too many requests, please slow down.", wait)
+
+                budget = queue_budget - upstream_queue_time()
+                if budget <= 0 or not slots.acquire(timeout=budget):
+                    logger.warning("Shedding %s request, queue budget of %.1fs exceeded",
+                                   name, queue_budget)
+                    return reject(503, "The server is busy, please try again shortly.",
+                                  retry_after)
+
+                try:
+                    response = make_response(view(*args, **kwargs))
+                except BaseException:
+                    slots.release()
+                    raise
+
+                # Streamed pages keep working after the view returns, so the slot
+                # is only freed once the whole body has been sent
+                response.call_on_close(slots.release)
+                return response
+
+            return wrapper
+
+        return decorator
+
+
+def reject(status, message, retry_after):
+    """Build a 429/503 response, as JSON for API routes and plain text otherwise."""
+    if request.path.startswith("/api/"):
+        response = jsonify({"error": message})
+    else:
+        response = make_response(message)
+        response.mimetype = "text/plain"
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
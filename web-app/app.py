@@ -3,16 +3,41 @@
 This Flask application provides a platform for tracking sandwich prices across NYC,
 allowing users to find affordable options in their area.
 """
+import atexit
+import json
 import math
 import logging
+import mimetypes
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import click
 import requests
-from flask import Flask, render_template, request, jsonify, url_for, redirect, flash
+from bson import json_util
+from bson.timestamp import Timestamp
+from flask import (Flask, Response, request, jsonify, url_for, redirect,
+                   flash, session, send_file, abort, get_flashed_messages)
+from flask.globals import request_ctx
+from jinja2.utils import htmlsafe_json_dumps
+from markupsafe import Markup
+from werkzeug.security import safe_join
 from pymongo import MongoClient
-
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import SecondaryPreferred
 from dotenv import load_dotenv
+
+from admission import AdmissionController, MemoryRateLimitStore, MongoRateLimitStore
+from build_assets import VENDOR_ASSETS
+from live_updates import BroadcastHub, ChangeStreamWatcher
+import export
+import geohash
+import regions
+from snapshot import NYC_BBOX, PriceSnapshot, SnapshotUnavailable, grid_shape
+from spatial_index import SpatialIndex, nearby_matches
+from stats import ALL_REGIONS, PriceStats
+
 load_dotenv()
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
@@ -24,12 +49,66 @@ logger = logging.getLogger(__name__)
 # Use environment variable with fallback to default
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://mongodb:27017")
 MONGO_DB = os.environ.get("MONGO_DB", "sandwich_db")
+# Reads may be served by a secondary that lags the primary by at most this many
+# seconds (MongoDB requires at least 90)
+MONGO_MAX_STALENESS_S = int(os.environ.get("MONGO_MAX_STALENESS_S", "90"))
+
+# Whether the collection is sharded on (borough, geohash), in which case box
+# queries name the shard key ranges they cover
+MONGO_SHARDED = os.environ.get("MONGO_SHARDED", "off") == "on"
+
+# Number of live updates buffered per /api/stream client before it is told to reload
+SSE_BUFFER_SIZE = int(os.environ.get("SSE_BUFFER_SIZE", "100"))
+SSE_HEARTBEAT_S = int(os.environ.get("SSE_HEARTBEAT_S", "15"))
+
+# Markers are embedded in the page in JSON chunks of this many rows, and the
+# streamed page is flushed every STREAM_BUFFER_EVENTS template output pieces
+MARKER_CHUNK_SIZE = 1000
+MARKER_PROJECTION = {"_id": 0, "name": 1, "address": 1, "lat": 1, "lon": 1, "price": 1,
+                     "last_updated": 1}
+STREAM_BUFFER_EVENTS = 64
+
+DEFAULT_STAT_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+
+# Batched nearby lookups: at most this many points per request, and distance
+# matrices are computed in slices of about NEARBY_MATRIX_CELLS point/deli pairs
+MAX_NEARBY_BATCH = 500
+# Nearby boxes reach 0.01 degrees (about 1 km) per unit of radius
+MAX_NEARBY_RADIUS = 50
+NEARBY_MATRIX_CELLS = 2000000
+
+# Heatmap resolution limits, so one request cannot ask for millions of cells
+MIN_HEATMAP_CELL_M = 50
+MAX_HEATMAP_CELLS = 250000
+
+# Answer nearby and map queries from an in-process index kept current by the
+# change stream, falling back to MongoDB when it is more than this many seconds behind
+SPATIAL_INDEX_ENABLED = os.environ.get("SPATIAL_INDEX", "off") == "on"
+SPATIAL_INDEX_MAX_LAG_S = float(os.environ.get("SPATIAL_INDEX_MAX_LAG_S", "5"))
+
+# Columnar exports read and encode this many prices at a time
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "10000"))
+
+# "memory" keeps rate limits per process, "mongodb" shares them between workers
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "on") != "off"
+# Reverse proxies in front of the app whose X-Forwarded-For entries identify
+# clients, 1 behind the App Platform load balancer
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+
+# Output of build_assets.py
+ASSET_DIST_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
 
 CLIENT = None
 DB = None
 COLLECTION = None
 COLLECTION_HELPER = None  # Renamed from 'collection' to follow naming convention
 
+def location_fields(lat, lon):
+    """Borough, neighborhood and geohash stored with every price."""
+    return {**regions.locate(lat, lon), "geohash": geohash.encode(lat, lon)}
+
 # pylint: disable=too-many-return-statements
 def init_db():
     """Initialize database connection and create initial data if needed.
@@ -51,7 +130,7 @@ def init_db():
     COLLECTION_HELPER = collection
 
     if collection.count_documents({}) == 0:
-        collection.insert_many([
+        samples = [
             {
                 "name": "Joe's Deli",
                 "address": "123 Broadway, New York, NY",
@@ -76,7 +155,22 @@ def init_db():
                 "price": 7.25,
                 "last_updated": datetime.now()
             }
-        ])
+        ]
+        # Tagged up front since the shard key cannot be backfilled once sharded
+        collection.insert_many([{**sample, **location_fields(sample["lat"], sample["lon"])}
+                                for sample in samples])
+
+    changed = regions.sync_tags(collection, database["app_meta"])
+    if changed is not None:
+        logger.info("Region files changed, retagged %d sandwiches", changed)
+    geohash.backfill(collection)
+    collection.create_index([("borough", 1), ("price", 1)])
+    collection.create_index([("neighborhood", 1), ("price", 1)])
+    database["price_stats"].create_index([("region", 1), ("bucket", 1)])
+    # Exports walk prices in last_updated order
+    collection.create_index("last_updated")
+    # Shard key, see README.md
+    collection.create_index([("borough", 1), ("geohash", 1)])
 
 try:
     init_db()
@@ -86,6 +180,194 @@ except Exception as e:  # pylint: disable=broad-except
     # Explicitly disable the warning since we want to catch any DB initialization errors
     logger.error("Database initialization error: %s", str(e))
 
+def read_collection():
+    """Get a collection handle that routes reads to secondaries when available.
+
+    On a standalone server this behaves exactly like COLLECTION.
+    """
+    return COLLECTION.with_options(
+        read_preference=SecondaryPreferred(max_staleness=MONGO_MAX_STALENESS_S)
+    )
+
+def remember_write(db_session):
+    """Save a causal session's position in the cookie so the next page sees the write."""
+    operation_time = db_session.operation_time
+    cluster_time = db_session.cluster_time
+    if not isinstance(operation_time, Timestamp) or not isinstance(cluster_time, dict):
+        return
+
+    session["causal_token"] = json_util.dumps(
+        {
+            "operation_time": operation_time,
+            "cluster_time": cluster_time,
+            "written_at": time.time()
+        },
+        json_options=json_util.CANONICAL_JSON_OPTIONS
+    )
+
+def current_causal_token():
+    """The user's last write position, or None if there is none.
+
+    Once a secondary could no longer be staler than the write, the token is dropped
+    and reads go back to being plain secondaryPreferred reads. Streamed pages call
+    this before the session cookie is sent, so the drop is saved.
+    """
+    token = session.get("causal_token")
+    if token is None:
+        return None
+
+    data = json_util.loads(token, json_options=json_util.CANONICAL_JSON_OPTIONS)
+    if time.time() - data["written_at"] > MONGO_MAX_STALENESS_S:
+        session.pop("causal_token", None)
+        return None
+    return data
+
+@contextmanager
+def causal_read_session():
+    """Yield a session that waits for the user's last write, or None if there is none."""
+    data = current_causal_token()
+    if data is None:
+        yield None
+        return
+
+    with CLIENT.start_session(causal_consistency=True) as db_session:
+        db_session.advance_cluster_time(data["cluster_time"])
+        db_session.advance_operation_time(data["operation_time"])
+        yield db_session
+
+def make_rate_limit_store():
+    """Create the token bucket store selected by RATE_LIMIT_STORE."""
+    if RATE_LIMIT_STORE == "mongodb":
+        store = MongoRateLimitStore(lambda: DB["rate_limits"])
+        try:
+            store.ensure_indexes()
+        except Exception as e:  # pylint: disable=broad-except
+            # Same as init_db, the app still starts if the database is down
+            logger.error("Could not create rate limit indexes: %s", str(e))
+        return store
+    return MemoryRateLimitStore()
+
+ADMISSION = AdmissionController(make_rate_limit_store(), enabled=ADMISSION_CONTROL,
+                                trusted_proxies=TRUSTED_PROXY_HOPS)
+
+HUB = BroadcastHub(buffer_size=SSE_BUFFER_SIZE)
+WATCHER = ChangeStreamWatcher(lambda: COLLECTION)
+
+def sandwich_event(sandwich):
+    """Convert a stored sandwich document into a JSON-friendly live update."""
+    last_updated = sandwich.get("last_updated")
+    return {
+        "name": sandwich["name"],
+        "address": sandwich["address"],
+        "lat": sandwich["lat"],
+        "lon": sandwich["lon"],
+        "price": sandwich["price"],
+        "color": get_marker_color(sandwich["price"]),
+        "last_updated": last_updated.isoformat() if last_updated else None
+    }
+
+WATCHER.add_listener(lambda sandwich: HUB.publish("price", sandwich_event(sandwich)))
+WATCHER.add_stop_listener(HUB.close_all)
+
+# Loaded from the primary once the change stream is open, like SPATIAL_INDEX
+SNAPSHOT = PriceSnapshot(
+    lambda: COLLECTION.find({}, {"_id": 0, "lat": 1, "lon": 1, "price": 1,
+                                 "last_updated": 1}),
+    WATCHER
+)
+WATCHER.add_listener(SNAPSHOT.add)
+WATCHER.add_change_listener(SNAPSHOT.invalidate)
+
+# Loaded from the primary so it is never behind the change stream it is tailing
+SPATIAL_INDEX = SpatialIndex(lambda: COLLECTION.find({}), WATCHER,
+                             enabled=SPATIAL_INDEX_ENABLED,
+                             max_lag_s=SPATIAL_INDEX_MAX_LAG_S)
+WATCHER.add_listener(SPATIAL_INDEX.add)
+WATCHER.add_change_listener(SPATIAL_INDEX.invalidate)
+
+def shard_target(query):
+    """Route a lat/lon box query to the shards owning it, see geohash.shard_target.
+
+    Unsharded deployments get the query back unchanged.
+    """
+    if not MONGO_SHARDED:
+        return query
+    return geohash.shard_target(query, lambda box: [
+        region.name for region in regions.BOROUGHS.intersecting(box)
+    ])
+
+def find_prices(query, projection=None, db_session=None):
+    """Run a find from the spatial index when it can answer it, or from MongoDB.
+
+    Reads inside a causal session always go to MongoDB, since the write they wait
+    for may have been made by another worker.
+    """
+    if db_session is None:
+        SPATIAL_INDEX.ensure_started()
+        results = SPATIAL_INDEX.find(query)
+        if results is not None:
+            return results
+    return list(read_collection().find(shard_target(query), projection or {"_id": 0},
+                                       session=db_session))
+
+STATS = PriceStats(lambda: DB["price_stats"])
+
+@atexit.register
+def flush_stats():
+    """Save this worker's unsaved price statistics on shutdown."""
+    try:
+        STATS.flush()
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Could not save price statistics: %s", str(e))
+
+def load_asset_manifest():
+    """Read the fingerprinted asset manifest, or an empty one if assets were never built."""
+    try:
+        with open(os.path.join(ASSET_DIST_DIR, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.warning("No asset manifest found, run build_assets.py to fingerprint assets")
+        return {}
+
+ASSET_MANIFEST = load_asset_manifest()
+
+@app.template_global()
+def asset_url(filename):
+    """URL for a static file, using its fingerprinted name when one has been built.
+
+    Without a build, vendored files that were never downloaded come from their CDN.
+    """
+    hashed = ASSET_MANIFEST.get(filename)
+    if hashed is not None:
+        return url_for("serve_asset", filename=hashed)
+    if filename in VENDOR_ASSETS and not os.path.isfile(
+            os.path.join(app.static_folder, filename)):
+        return VENDOR_ASSETS[filename][0]
+    return url_for("static", filename=filename)
+
+@app.route("/assets/<path:filename>", methods=["GET"])
+def serve_asset(filename):
+    """Serve a fingerprinted asset forever, precompressed if the client accepts it."""
+    path = safe_join(ASSET_DIST_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+            encoding = candidate
+            path += suffix
+            break
+
+    response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
 def get_marker_color(price):
     """Get color code for price marker."""
     if price < 6.00:
@@ -143,10 +425,10 @@ def geocode_address(address):
 
 def find_nearby_sandwiches(lat, lon, radius=1):
     """Find sandwiches near a specific location."""
-    results = list(COLLECTION.find({
+    results = find_prices({
         "lat": {"$gt": lat - 0.01 * radius, "$lt": lat + 0.01 * radius},
         "lon": {"$gt": lon - 0.01 * radius, "$lt": lon + 0.01 * radius}
-    }, {"_id": 0}))
+    })
 
     for result in results:
         distance = math.sqrt((result["lat"] - lat)**2 + (result["lon"] - lon)**2) * 111  # km
@@ -156,6 +438,21 @@ def find_nearby_sandwiches(lat, lon, radius=1):
 
     return results
 
+def find_nearby_sandwiches_batch(points):
+    """Find sandwiches near each of many (lat, lon, radius) points with one query.
+
+    Each point matches the same box as find_nearby_sandwiches, and its results are
+    sorted by haversine distance.
+    """
+    if not points:
+        return []
+    boxes = [shard_target({
+        "lat": {"$gt": lat - 0.01 * radius, "$lt": lat + 0.01 * radius},
+        "lon": {"$gt": lon - 0.01 * radius, "$lt": lon + 0.01 * radius}
+    }) for lat, lon, radius in points]
+    candidates = list(read_collection().find({"$or": boxes}, {"_id": 0}))
+    return nearby_matches(points, candidates, NEARBY_MATRIX_CELLS)
+
 def filter_sandwiches(sandwiches):
     """
     Filters sandwiches to ensure each location is only shown once, showing
@@ -175,6 +472,58 @@ def filter_sandwiches(sandwiches):
     return unique_locations.values()
 
 
+def iter_marker_json(query):
+    """Yield the map markers as pieces of one compact JSON array body.
+
+    Each marker is a [lat, lon, price, name, address] tuple. This runs while the page
+    is already streaming, so the collection is only read once the header and sidebar
+    are on their way to the browser. By then the status has been sent, so if the
+    read fails the map is left empty rather than cutting the page off.
+    """
+    try:
+        with causal_read_session() as db_session:
+            sandwiches = find_prices(query, MARKER_PROJECTION, db_session)
+    except (PyMongoError, AttributeError) as e:
+        # AttributeError: COLLECTION is None when the database was never reached
+        logger.error("Could not load map markers: %s", str(e))
+        return
+
+    rows = [
+        [s["lat"], s["lon"], s["price"], s["name"], s["address"]]
+        for s in filter_sandwiches(sandwiches)
+    ]
+    for start in range(0, len(rows), MARKER_CHUNK_SIZE):
+        chunk = htmlsafe_json_dumps(rows[start:start + MARKER_CHUNK_SIZE])[1:-1]
+        if start + MARKER_CHUNK_SIZE < len(rows):
+            chunk += ","
+        yield Markup(chunk)
+
+def stream_page(**context):
+    """Stream index.html so the first bytes go out before the markers are loaded."""
+    # Flashes and expired causal tokens are popped here rather than while the
+    # markers are read because the session cookie is sent before the streamed
+    # body is rendered
+    context["messages"] = get_flashed_messages(with_categories=True)
+    current_causal_token()
+    app.update_template_context(context)
+    page = app.jinja_env.get_template("index.html").stream(context)
+    page.enable_buffering(STREAM_BUFFER_EVENTS)
+
+    # Like stream_with_context, but the context is only pushed while a chunk is
+    # being rendered, so a response that is abandoned halfway never leaves it
+    # on the stack
+    ctx = request_ctx.copy()
+
+    def generate():
+        while True:
+            with ctx:
+                chunk = next(page, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    return Response(generate(), mimetype="text/html")
+
 @app.route("/")
 def home():
     """Render the main application with all sandwich data."""
@@ -190,31 +539,15 @@ def home():
         else:
             query["price"] = {"$lte": max_price}
 
-    sandwiches = list(COLLECTION.find(query, {"_id": 0}))
-    sandwiches = filter_sandwiches(sandwiches)
-
-
-    if sandwiches:
-        center_lat = sum(s["lat"] for s in sandwiches) / len(sandwiches)
-        center_lon = sum(s["lon"] for s in sandwiches) / len(sandwiches)
-    else:
-        center_lat = 40.755
-        center_lon = -73.978
-
-    for sandwich in sandwiches:
-        sandwich["color"] = get_marker_color(sandwich["price"])
-
-    return render_template(
-        "index.html",
-        sandwiches=sandwiches,
-        center_lat=center_lat,
-        center_lon=center_lon,
+    return stream_page(
+        markers=iter_marker_json(query),
         min_price=min_price,
         max_price=max_price,
         search_results=None
     )
 
 @app.route("/search", methods=["GET", "POST"])
+@ADMISSION.limit("search", concurrency=8, rate=1, burst=10, queue_budget=2)
 def search():
     """Handle address search and show results."""
     search_results = None
@@ -237,32 +570,11 @@ def search():
         else:
             flash("Could not find this address. Please try a more specific NYC address.", "error")
 
-    all_sandwiches = list(COLLECTION.find({}, {"_id": 0}))
+    # Without a search result the map centers on the markers themselves
+    zoom_level = 16 if search_results else 13
 
-    all_sandwiches = filter_sandwiches(all_sandwiches)
-
-    for sandwich in all_sandwiches:
-        sandwich["color"] = get_marker_color(sandwich["price"])
-
-    if search_results:
-        center_lat = search_results["lat"]
-        center_lon = search_results["lon"]
-        zoom_level = 16
-    elif all_sandwiches:
-        center_lat = sum(s["lat"] for s in all_sandwiches) / len(all_sandwiches)
-        center_lon = sum(s["lon"] for s in all_sandwiches) / len(all_sandwiches)
-        zoom_level = 13
-    else:
-        center_lat = 40.755
-        center_lon = -73.978
-        zoom_level = 13
-
-
-    return render_template(
-        "index.html",
-        sandwiches=all_sandwiches,
-        center_lat=center_lat,
-        center_lon=center_lon,
+    return stream_page(
+        markers=iter_marker_json({}),
         search_query=address,
         search_results=search_results,
         nearby_sandwiches=nearby_sandwiches,
@@ -284,6 +596,7 @@ def validate_sandwich_input(name, address, price_str):
 
 # pylint: disable=too-many-return-statements
 @app.route("/add", methods=["POST"])
+@ADMISSION.limit("add", concurrency=4, rate=0.2, burst=5, queue_budget=2)
 def add_sandwich():
     """Handle adding a new sandwich price."""
     if request.method != "POST":
@@ -311,10 +624,18 @@ def add_sandwich():
             "lat": geocode_result["lat"],
             "lon": geocode_result["lon"],
             "price": price,
-            "last_updated": datetime.now()
+            "last_updated": datetime.now(),
+            **location_fields(geocode_result["lat"], geocode_result["lon"])
         }
 
-        COLLECTION.insert_one(sandwich)
+        # The redirect back to "/" may read from a secondary, so keep track of
+        # this write to make sure the new price shows up on the map
+        with CLIENT.start_session(causal_consistency=True) as db_session:
+            COLLECTION.insert_one(sandwich, session=db_session)
+            remember_write(db_session)
+        SNAPSHOT.add(sandwich)
+        SPATIAL_INDEX.add(sandwich)
+        STATS.record(sandwich)
 
         flash(f"Added {name} with price ${price:.2f}", "success")
         logger.info("Added new sandwich shop: %s at %s", name, address)
@@ -336,6 +657,7 @@ def add_sandwich():
         return redirect(url_for("home"))
 
 @app.route("/api/geocode", methods=["GET"])
+@ADMISSION.limit("geocode", concurrency=4, rate=1, burst=10, queue_budget=1)
 def api_geocode():
     """API endpoint for geocoding an address."""
     address = request.args.get("address", "")
@@ -350,6 +672,11 @@ def api_geocode():
 
     return jsonify(result)
 
+def valid_nearby_point(lat, lon, radius):
+    """Whether a nearby lookup has real coordinates and a radius we are willing to search."""
+    return (-90 <= lat <= 90 and -180 <= lon <= 180 and
+            0 < radius <= MAX_NEARBY_RADIUS)
+
 @app.route("/api/sandwiches/nearby", methods=["GET"])
 def get_nearby_sandwiches():
     """API endpoint to get nearby sandwich shops."""
@@ -362,10 +689,193 @@ def get_nearby_sandwiches():
         radius = float(request.args.get("radius", 1))
     except ValueError:
         return jsonify({"error": "Invalid coordinates"}), 400
+    if not valid_nearby_point(lat, lon, radius):
+        return jsonify({"error": "Invalid coordinates"}), 400
 
     results = find_nearby_sandwiches(lat, lon, radius)
     return jsonify(results)
 
+@app.route("/api/sandwiches/nearby/batch", methods=["POST"])
+@ADMISSION.limit("nearby_batch", concurrency=4, rate=1, burst=5, queue_budget=2)
+def get_nearby_sandwiches_batch():
+    """API endpoint to get nearby sandwich shops for many points at once."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Send a JSON object with a list of points"}), 400
+    raw_points = data.get("points")
+    if not isinstance(raw_points, list) or not raw_points:
+        return jsonify({"error": "Provide a non-empty list of points"}), 400
+    if len(raw_points) > MAX_NEARBY_BATCH:
+        return jsonify({"error": f"At most {MAX_NEARBY_BATCH} points per request"}), 400
+
+    try:
+        points = [(float(point["lat"]), float(point["lon"]), float(point.get("radius", 1)))
+                  for point in raw_points]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Each point needs numeric lat and lon"}), 400
+    if not all(valid_nearby_point(*point) for point in points):
+        return jsonify({"error": "Each point needs numeric lat and lon"}), 400
+
+    return jsonify({"results": find_nearby_sandwiches_batch(points)})
+
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    """Server-Sent Events stream of newly added sandwich prices.
+
+    Answers 204 when the server cannot do change streams, which tells EventSource
+    not to reconnect.
+    """
+    WATCHER.ensure_started()
+    if WATCHER.unsupported:
+        return Response(status=204)
+    subscriber = HUB.subscribe()
+    # The watcher may have given up while we subscribed
+    if WATCHER.unsupported:
+        HUB.unsubscribe(subscriber)
+        return Response(status=204)
+    return Response(
+        HUB.stream(subscriber, heartbeat=SSE_HEARTBEAT_S),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def parse_bbox(value):
+    """Parse a "west,south,east,north" bounding box, defaulting to all of NYC."""
+    if not value:
+        return NYC_BBOX
+    west, south, east, north = (float(part) for part in value.split(","))
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and
+            -90 <= south <= 90 and -90 <= north <= 90):
+        raise ValueError("bbox edges must be longitudes and latitudes")
+    if west >= east or south >= north:
+        raise ValueError("bbox must be west,south,east,north")
+    return west, south, east, north
+
+@app.route("/api/heatmap", methods=["GET"])
+def api_heatmap():
+    """API endpoint for a grid of price counts, medians and means across the city."""
+    try:
+        cell_m = float(request.args.get("cell_m", 500))
+        bbox = parse_bbox(request.args.get("bbox"))
+    except ValueError:
+        return jsonify({"error": "Invalid cell_m or bbox"}), 400
+
+    if not math.isfinite(cell_m) or cell_m < MIN_HEATMAP_CELL_M:
+        return jsonify({"error": f"cell_m must be at least {MIN_HEATMAP_CELL_M}"}), 400
+    _, _, rows, cols = grid_shape(cell_m, bbox)
+    if rows * cols > MAX_HEATMAP_CELLS:
+        return jsonify({"error": "Too many cells, use a larger cell_m or smaller bbox"}), 400
+
+    try:
+        return jsonify(SNAPSHOT.heatmap(cell_m, bbox))
+    except SnapshotUnavailable:
+        return jsonify({"error": "Prices are still loading, please try again"}), 503, {
+            "Retry-After": "1"
+        }
+
+@app.route("/api/spatial-index", methods=["GET"])
+def api_spatial_index():
+    """API endpoint for the size and staleness of the in-process spatial index."""
+    return jsonify(SPATIAL_INDEX.status())
+
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    """API endpoint for price statistics per region over a range of days."""
+    regions_param = request.args.getlist("region") or [ALL_REGIONS]
+    try:
+        start = request.args.get("from")
+        start = datetime.fromisoformat(start) if start else None
+        end = request.args.get("to")
+        end = datetime.fromisoformat(end) if end else None
+        quantiles = [float(q) for q in request.args.getlist("q")] or DEFAULT_STAT_QUANTILES
+    except ValueError:
+        return jsonify({"error": "Invalid from, to or q parameter"}), 400
+    if not all(0 <= q <= 1 for q in quantiles):
+        return jsonify({"error": "Quantiles must be between 0 and 1"}), 400
+
+    digest = STATS.query(regions_param, start, end)
+    empty = digest.count == 0
+    return jsonify({
+        "regions": regions_param,
+        "from": start.isoformat() if start else None,
+        "to": end.isoformat() if end else None,
+        "count": digest.count,
+        "min": None if empty else digest.min,
+        "max": None if empty else digest.max,
+        "mean": None if empty else round(digest.total / digest.count, 2),
+        "quantiles": {str(q): None if empty else round(digest.quantile(q), 2)
+                      for q in quantiles}
+    })
+
+@app.cli.command("retag-regions")
+def retag_regions_command():
+    """Recompute every stored borough and neighborhood from the region files."""
+    changed = regions.retag(COLLECTION)
+    regions.save_version(DB["app_meta"])
+    print(f"Retagged {changed} sandwiches, run rebuild-stats to update region statistics")
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute all price statistics from the stored prices."""
+    count = STATS.rebuild(COLLECTION.find({}, {"_id": 0, "price": 1, "last_updated": 1,
+                                               "borough": 1, "neighborhood": 1}))
+    print(f"Rebuilt price statistics from {count} prices")
+
+@app.route("/api/export", methods=["GET"])
+@ADMISSION.limit("export", concurrency=2, rate=0.1, burst=2, queue_budget=1)
+def api_export():
+    """API endpoint that streams prices as a Parquet or Arrow IPC file.
+
+    `since` exports only prices updated after a previous export's watermark, which
+    is returned in the X-Export-Watermark header.
+    """
+    if not export.available():
+        return jsonify({"error": "Exports need pyarrow to be installed"}), 503
+
+    export_format = request.args.get("format", "parquet")
+    if export_format not in export.FORMATS:
+        return jsonify({"error": "format must be parquet or arrow"}), 400
+    try:
+        since = request.args.get("since")
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return jsonify({"error": "Invalid since parameter"}), 400
+
+    until, query = export.export_window(since)
+    # From the primary, since a secondary may be further behind than SETTLE_TIME and
+    # the next export would start after prices it had not replicated yet
+    cursor = export.find_window(COLLECTION, query, EXPORT_CHUNK_SIZE)
+    mimetype, extension = export.FORMATS[export_format]
+    return Response(
+        export.stream_export(cursor, export_format, EXPORT_CHUNK_SIZE),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition":
+                f"attachment; filename=sandwich_prices-{until:%Y%m%dT%H%M%S}.{extension}",
+            "X-Export-Watermark": until.isoformat()
+        }
+    )
+
+@app.cli.command("export")
+@click.argument("output")
+@click.option("--format", "export_format", type=click.Choice(sorted(export.FORMATS)),
+              default="parquet")
+@click.option("--since", help="Only export prices updated after this ISO timestamp.")
+@click.option("--watermark-file", type=click.Path(dir_okay=False),
+              help="Read --since from this file and save the new watermark to it.")
+def export_command(output, export_format, since, watermark_file):
+    """Write prices to a Parquet or Arrow IPC file."""
+    if not export.available():
+        raise click.ClickException("Exports need pyarrow to be installed")
+    try:
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--since") from e
+
+    rows, until = export.export_file(COLLECTION, output, export_format, since,
+                                     watermark_file, EXPORT_CHUNK_SIZE)
+    print(f"Exported {rows} prices up to {until.isoformat()} to {output}")
+
 def build_sandwich_query():
     """Build query for sandwich filtering from request arguments."""
     query = {}
@@ -387,6 +897,20 @@ def build_sandwich_query():
         except ValueError:
             return None, "Invalid max price"
 
+    # Both are tagged on write and indexed together with price
+    for field in ("borough", "neighborhood"):
+        value = request.args.get(field)
+        if value:
+            query[field] = value
+
+    if request.args.get("bbox"):
+        try:
+            west, south, east, north = parse_bbox(request.args["bbox"])
+        except ValueError:
+            return None, "Invalid bbox"
+        query["lat"] = {"$gte": south, "$lte": north}
+        query["lon"] = {"$gte": west, "$lte": east}
+
     return query, None
 
 @app.route("/api/sandwiches", methods=["GET"])
@@ -396,7 +920,7 @@ def get_sandwiches():
     if error:
         return jsonify({"error": error}), 400
 
-    sandwiches = list(COLLECTION.find(query, {"_id": 0}))
+    sandwiches = find_prices(query)
     return jsonify(sandwiches)
 
 # pylint: disable=too-many-return-statements
@@ -441,13 +965,17 @@ def api_add_sandwich():
             "lat": lat,
             "lon": lon,
             "price": price,
-            "last_updated": datetime.now()
+            "last_updated": datetime.now(),
+            **location_fields(lat, lon)
         }
 
         result = COLLECTION.insert_one(sandwich)
 
         if not result.inserted_id:
             return jsonify({"error": "Failed to add sandwich"}), 500
+        SNAPSHOT.add(sandwich)
+        SPATIAL_INDEX.add(sandwich)
+        STATS.record(sandwich)
 
         logger.info("API added new sandwich shop: %s", data["name"])
         return jsonify({"success": True}), 201
@@ -0,0 +1,198 @@
+"""Build fingerprinted, precompressed static assets for the NYC Sandwich Price Tracker.
+
+Downloads the third-party files the page needs (Leaflet and FontAwesome) into
+static/vendor, then copies everything under static/ into static/dist with a content
+hash in each file name, writes .gz and .br variants next to the text files, and
+emits static/dist/manifest.json mapping original paths to hashed ones.
+
+Run it once before starting the app outside Docker:
+
+    python build_assets.py
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import sys
+
+import requests
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip still works
+    brotli = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIRNAME = "dist"
+MANIFEST_NAME = "manifest.json"
+
+LEAFLET_URL = "https://unpkg.com/leaflet@1.9.3/dist"
+FONTAWESOME_URL = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0"
+
+# Local path under static/ -> where to fetch it from and its SHA-256, so a
+# compromised or changed CDN file fails the build instead of being shipped
+VENDOR_ASSETS = {
+    "vendor/leaflet/leaflet.css": (
+        f"{LEAFLET_URL}/leaflet.css",
+        "90b693d86392a4779c861b28cf307e7e59c3fb35328c4d8b95f58f814d38c722"),
+    "vendor/leaflet/leaflet.js": (
+        f"{LEAFLET_URL}/leaflet.js",
+        "5819285cec137b229c94e1ee5ad73e8b6b84345a4367d60f75fe477fe0fb7b03"),
+    "vendor/leaflet/images/layers.png": (
+        f"{LEAFLET_URL}/images/layers.png",
+        "1dbbe9d028e292f36fcba8f8b3a28d5e8932754fc2215b9ac69e4cdecf5107c6"),
+    "vendor/leaflet/images/layers-2x.png": (
+        f"{LEAFLET_URL}/images/layers-2x.png",
+        "066daca850d8ffbef007af00b06eac0015728dee279c51f3cb6c716df7c42edf"),
+    "vendor/leaflet/images/marker-icon.png": (
+        f"{LEAFLET_URL}/images/marker-icon.png",
+        "574c3a5cca85f4114085b6841596d62f00d7c892c7b03f28cbfa301deb1dc437"),
+    "vendor/leaflet/images/marker-icon-2x.png": (
+        f"{LEAFLET_URL}/images/marker-icon-2x.png",
+        "00179c4c1ee830d3a108412ae0d294f55776cfeb085c60129a39aa6fc4ae2528"),
+    "vendor/leaflet/images/marker-shadow.png": (
+        f"{LEAFLET_URL}/images/marker-shadow.png",
+        "264f5c640339f042dd729062cfc04c17f8ea0f29882b538e3848ed8f10edb4da"),
+    "vendor/fontawesome/css/fontawesome.min.css": (
+        f"{FONTAWESOME_URL}/css/fontawesome.min.css",
+        "3dc869c82a722d9fd7c7d881a453ee3d269d461917c7a27901ad357d9dcbbfc4"),
+    "vendor/fontawesome/css/solid.min.css": (
+        f"{FONTAWESOME_URL}/css/solid.min.css",
+        "b43dcc895ec8fa778047b69062f1920729246b946fba0c34cddd15e558a801e3"),
+    "vendor/fontawesome/webfonts/fa-solid-900.woff2": (
+        f"{FONTAWESOME_URL}/webfonts/fa-solid-900.woff2",
+        "7152a6933ee3d690ec2af3d09da9d701723d16aa3410a6d80f28ff8866f3b880"),
+    "vendor/fontawesome/webfonts/fa-solid-900.ttf": (
+        f"{FONTAWESOME_URL}/webfonts/fa-solid-900.ttf",
+        "67a65763c7f80903d81603bbeb9049fc2bf28508479b83ed011fe24c71fa950a"),
+}
+
+# Only these are worth compressing, images and woff2 fonts already are
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".json", ".svg", ".ttf", ".txt", ".html"}
+
+CSS_URL_PATTERN = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+def vendor_assets(static_dir=STATIC_DIR):
+    """Download any vendored file that is missing or does not match its pinned digest."""
+    for path, (url, sha256) in VENDOR_ASSETS.items():
+        target = os.path.join(static_dir, path)
+        if os.path.exists(target):
+            with open(target, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() == sha256:
+                    continue
+
+        logger.info("Downloading %s", url)
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        if digest != sha256:
+            raise ValueError(f"{url} has SHA-256 {digest}, expected {sha256}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(response.content)
+
+
+def fingerprint(path, content):
+    """Insert a short content hash before the extension, e.g. app.css -> app.1a2b3c4d5e.css."""
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    root, ext = posixpath.splitext(path)
+    if root.endswith(".min"):
+        root, ext = root[:-4], ".min" + ext
+    return f"{root}.{digest}{ext}"
+
+
+def rewrite_css_urls(path, content, manifest):
+    """Point relative url() references in a stylesheet at their fingerprinted files."""
+    base = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.groups()
+        clean_url = url.split("?", 1)[0].split("#", 1)[0]
+        if clean_url.startswith(("data:", "http:", "https:", "//", "/")):
+            return match.group(0)
+
+        target = posixpath.normpath(posixpath.join(base, clean_url))
+        if target not in manifest:
+            return match.group(0)
+
+        suffix = url[len(clean_url):]
+        hashed = posixpath.relpath(manifest[target], base) + suffix
+        return f"url({quote}{hashed}{quote})"
+
+    return CSS_URL_PATTERN.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def write_compressed(target, content):
+    """Write .gz and .br siblings when they actually save bytes."""
+    gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+    if len(gzipped) < len(content):
+        with open(target + ".gz", "wb") as f:
+            f.write(gzipped)
+
+    if brotli is not None:
+        compressed = brotli.compress(content, quality=11)
+        if len(compressed) < len(content):
+            with open(target + ".br", "wb") as f:
+                f.write(compressed)
+
+
+def collect_sources(static_dir):
+    """List every file under static/ except previous build output, as posix paths."""
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and DIST_DIRNAME in dirs:
+            dirs.remove(DIST_DIRNAME)
+        for name in files:
+            full_path = os.path.join(root, name)
+            sources.append(os.path.relpath(full_path, static_dir).replace(os.sep, "/"))
+    return sorted(sources)
+
+
+def build(static_dir=STATIC_DIR):
+    """Rebuild static/dist and return the manifest."""
+    dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    # Stylesheets go last so the files they reference already have hashed names
+    sources = collect_sources(static_dir)
+    sources.sort(key=lambda path: path.endswith(".css"))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), "rb") as f:
+            content = f.read()
+        if path.endswith(".css"):
+            content = rewrite_css_urls(path, content, manifest)
+
+        hashed = fingerprint(path, content)
+        manifest[path] = hashed
+
+        target = os.path.join(dist_dir, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(content)
+        if posixpath.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+            write_compressed(target, content)
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    logger.info("Built %d assets into %s", len(manifest), dist_dir)
+    return manifest
+
+
+if __name__ == "__main__":
+    try:
+        vendor_assets()
+    except requests.RequestException as e:
+        logger.error("Could not download vendored assets: %s", str(e))
+        sys.exit(1)
+    build()
@@ -0,0 +1,170 @@
+"""Columnar exports of stored prices for the NYC Sandwich Price Tracker.
+
+Prices are read from a cursor in chunks and each chunk is written as one Parquet
+row group or Arrow IPC record batch, so memory use depends on the chunk size and
+not on the size of the collection. Exports cover a window of last_updated times,
+and the end of one window is the watermark the next incremental export starts from.
+"""
+import os
+from datetime import datetime, timedelta
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - exports are off without pyarrow
+    pa = pq = None
+
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows")
+}
+
+# Prices newer than this are left for the next export, so one that was stamped
+# just before the export started but inserted after it is not skipped. This only
+# holds when reading from the primary, as secondaries may lag by longer.
+SETTLE_TIME = timedelta(seconds=60)
+
+COLUMNS = ("id", "name", "address", "lat", "lon", "price", "last_updated",
+           "borough", "neighborhood")
+PROJECTION = {"name": 1, "address": 1, "lat": 1, "lon": 1, "price": 1, "last_updated": 1,
+              "borough": 1, "neighborhood": 1}
+
+
+def available():
+    """Whether pyarrow is installed."""
+    return pa is not None
+
+
+def schema():
+    """Arrow schema of an export."""
+    return pa.schema([
+        ("id", pa.string()),
+        ("name", pa.string()),
+        ("address", pa.string()),
+        ("lat", pa.float64()),
+        ("lon", pa.float64()),
+        ("price", pa.float64()),
+        ("last_updated", pa.timestamp("ms")),
+        ("borough", pa.string()),
+        ("neighborhood", pa.string())
+    ])
+
+
+def export_window(since=None, until=None):
+    """The (since, until] window to export and the query that selects it."""
+    until = until or datetime.now() - SETTLE_TIME
+    query = {"last_updated": {"$lte": until}}
+    if since:
+        query["last_updated"]["$gt"] = since
+    return until, query
+
+
+def find_window(collection, query, chunk_size):
+    """Cursor over a window, oldest first, fetching chunk_size documents at a time."""
+    return collection.find(query, PROJECTION).sort("last_updated", 1).batch_size(chunk_size)
+
+
+def record_batches(documents, chunk_size):
+    """Turn documents into Arrow record batches of at most chunk_size rows."""
+    export_schema = schema()
+    chunk = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) == chunk_size:
+            yield to_record_batch(chunk, export_schema)
+            chunk = []
+    if chunk:
+        yield to_record_batch(chunk, export_schema)
+
+
+def to_record_batch(documents, export_schema):
+    """Convert one chunk of documents to columns."""
+    columns = {name: [] for name in COLUMNS}
+    for document in documents:
+        columns["id"].append(str(document["_id"]) if "_id" in document else None)
+        for name in COLUMNS[1:]:
+            columns[name].append(document.get(name))
+    return pa.RecordBatch.from_pydict(columns, schema=export_schema)
+
+
+class ChunkSink:
+    """Write-only file object that hands out whatever was written since the last take."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def open_writer(sink, export_format):
+    """Parquet or Arrow IPC stream writer for the export schema."""
+    if export_format == "parquet":
+        return pq.ParquetWriter(sink, schema(), compression="zstd")
+    return pa.ipc.new_stream(sink, schema())
+
+
+def write_export(documents, sink, export_format, chunk_size=10000):
+    """Write documents to a file object or path, returning the number of rows."""
+    rows = 0
+    with open_writer(sink, export_format) as writer:
+        for batch in record_batches(documents, chunk_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def export_file(collection, output, export_format, since=None, watermark_file=None,
+                chunk_size=10000):
+    """Export a window to a file, returning the number of rows and the new watermark.
+
+    With a watermark_file and no since, the export starts where the one that
+    wrote the file left off, and the file is advanced once the export is complete.
+    """
+    if watermark_file and since is None and os.path.exists(watermark_file):
+        with open(watermark_file, encoding="utf-8") as f:
+            saved = f.read().strip()
+        since = datetime.fromisoformat(saved) if saved else None
+
+    until, query = export_window(since)
+    rows = write_export(find_window(collection, query, chunk_size), output, export_format,
+                        chunk_size)
+
+    # Only saved once the file is complete, so a failed export is simply retried
+    if watermark_file:
+        with open(watermark_file, "w", encoding="utf-8") as f:
+            f.write(until.isoformat())
+    return rows, until
+
+
+def stream_export(documents, export_format, chunk_size=10000):
+    """Yield the bytes of an export as each chunk is encoded."""
+    sink = ChunkSink()
+    with open_writer(sink, export_format) as writer:
+        for batch in record_batches(documents, chunk_size):
+            writer.write_batch(batch)
+            data = sink.take()
+            if data:
+                yield data
+    data = sink.take()
+    if data:
+        yield data
@@ -0,0 +1,162 @@
+"""Geohash encoding and box coverings for the NYC Sandwich Price Tracker.
+
+A geohash interleaves longitude and latitude bits and writes them in base 32, so
+points that share a prefix are in the same cell and a cell's points form one
+contiguous range of strings. That makes the geohash usable as the second part of
+the shard key: a lat/lon box turns into a few string ranges that mongos can route
+to the shards owning them.
+"""
+import math
+
+from pymongo import UpdateOne
+
+from spatial_index import bounds
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# About 5 meters, so stored hashes can serve any coarser prefix
+PRECISION = 9
+
+
+def encode(lat, lon, precision=PRECISION):
+    """Geohash of a point."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """Height and width in degrees of a cell at this precision."""
+    lon_bits = math.ceil(5 * precision / 2)
+    lat_bits = 5 * precision - lon_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def _cells(west, south, east, north, precision):
+    """Row and column ranges of the cells covering a box."""
+    height, width = cell_size(precision)
+    rows = range(math.floor((south + 90) / height), math.floor((north + 90) / height) + 1)
+    cols = range(math.floor((west + 180) / width), math.floor((east + 180) / width) + 1)
+    return rows, cols, height, width
+
+
+def covering_prefixes(west, south, east, north, max_cells=8):
+    """The finest set of at most max_cells geohash prefixes covering a box.
+
+    Empty if even single character prefixes would take more than max_cells.
+    """
+    west, east = max(west, -180.0), min(east, 180.0)
+    south, north = max(south, -90.0), min(north, 90.0)
+    rows, cols, _, _ = _cells(west, south, east, north, 1)
+    if len(rows) * len(cols) > max_cells:
+        return []
+
+    precision = 1
+    while precision < PRECISION:
+        rows, cols, _, _ = _cells(west, south, east, north, precision + 1)
+        if len(rows) * len(cols) > max_cells:
+            break
+        precision += 1
+
+    rows, cols, height, width = _cells(west, south, east, north, precision)
+    return sorted({
+        encode(min((row + 0.5) * height - 90, 90), min((col + 0.5) * width - 180, 180),
+               precision)
+        for row in rows for col in cols
+    })
+
+
+def successor(prefix):
+    """Smallest string greater than every string starting with prefix, or None."""
+    prefix = prefix.rstrip(BASE32[-1])
+    if not prefix:
+        return None
+    return prefix[:-1] + BASE32[BASE32.index(prefix[-1]) + 1]
+
+
+def _next(prefix):
+    """The following cell at the same precision, or None after the last one."""
+    digits = [BASE32.index(char) for char in prefix]
+    for i in reversed(range(len(digits))):
+        if digits[i] < len(BASE32) - 1:
+            digits[i] += 1
+            return "".join(BASE32[d] for d in digits[:i + 1]) + BASE32[0] * (len(digits) - i - 1)
+    return None
+
+
+def prefix_ranges(prefixes):
+    """Merge sorted same-length prefixes into [low, high) ranges, high None if unbounded."""
+    runs = []
+    for prefix in prefixes:
+        if runs and _next(runs[-1][1]) == prefix:
+            runs[-1][1] = prefix
+        else:
+            runs.append([prefix, prefix])
+    return [(first, successor(last)) for first, last in runs]
+
+
+def shard_target(query, boroughs_in):
+    """Add shard key conditions to a query over a lat/lon box.
+
+    The shard key is (borough, geohash), so the box becomes one geohash range per
+    covering cell for each borough it overlaps, plus untagged prices. mongos then
+    only asks the shards owning those ranges instead of all of them.
+    `boroughs_in(bbox)` names the boroughs that may overlap a (west, south, east,
+    north) box.
+    """
+    lat, lon = query.get("lat"), query.get("lon")
+    if not isinstance(lat, dict) or not isinstance(lon, dict) or "$or" in query:
+        return query
+    south, north = bounds(lat)
+    west, east = bounds(lon)
+    if not all(math.isfinite(edge) for edge in (south, north, west, east)):
+        return query
+
+    if isinstance(query.get("borough"), str):
+        boroughs = [query["borough"]]
+    else:
+        boroughs = boroughs_in((west, south, east, north)) + [None]
+    prefixes = covering_prefixes(west, south, east, north)
+    if not prefixes:
+        # Too big a box to be worth targeting
+        return query
+    hashes = [{"$gte": low, "$lt": high} if high else {"$gte": low}
+              for low, high in prefix_ranges(prefixes)]
+    return {**query, "$or": [{"borough": borough, "geohash": hash_range}
+                             for borough in boroughs for hash_range in hashes]}
+
+
+def backfill(collection, batch_size=1000):
+    """Add the geohash shard key field to stored sandwiches that predate it.
+
+    This has to happen before the collection is sharded.
+    """
+    updates = []
+    for sandwich in collection.find({"geohash": {"$exists": False}}, {"lat": 1, "lon": 1}):
+        updates.append(UpdateOne({"_id": sandwich["_id"]}, {
+            "$set": {"geohash": encode(sandwich["lat"], sandwich["lon"])}
+        }))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
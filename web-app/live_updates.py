@@ -0,0 +1,207 @@
+"""Live price updates for the NYC Sandwich Price Tracker.
+
+A single change stream watcher per process tails the sandwich_prices collection
+and hands every new document to its listeners, and tells its change listeners
+when existing documents are updated, replaced or deleted. The broadcast hub is one of those
+listeners and fans the updates out to all connected Server-Sent Events clients.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Server error codes for a resume token that has fallen off the oplog, and for
+# change streams on a standalone server, which will never work
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+
+class BroadcastHub:
+    """Fan out events from one producer to many SSE clients.
+
+    Every subscriber gets its own bounded buffer. A client whose buffer fills up is
+    sent a reset event and dropped, so one slow browser never holds up the watcher
+    or the other clients.
+    """
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self):
+        """Register a new client and return its buffer."""
+        subscriber = queue.Queue(maxsize=self.buffer_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Forget about a client that has gone away."""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        """Queue an event for every subscriber without ever blocking."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                self._overflow(subscriber)
+
+    def _overflow(self, subscriber):
+        """Replace a lagging client's backlog with a single reset event."""
+        self.unsubscribe(subscriber)
+        logger.warning("SSE client fell %d events behind, asking it to reload",
+                       self.buffer_size)
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.put_nowait(("reset", None))
+
+    def close_all(self):
+        """Tell every client there will be no more updates and drop them."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(("end", None))
+            except queue.Full:
+                pass
+
+    def stream(self, subscriber, heartbeat=15):
+        """Yield SSE-formatted messages for one subscriber until it is reset.
+
+        A comment line is sent whenever nothing has happened for `heartbeat` seconds
+        so proxies keep the connection open and dead clients are noticed.
+        """
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event in ("reset", "end"):
+                    return
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class ChangeStreamWatcher:
+    """Tail inserts, updates and deletes on a collection in a background thread.
+
+    The thread is only started on first use, and it resumes from the last seen
+    change after errors so listeners do not miss updates.
+    """
+
+    def __init__(self, get_collection, retry_delay=5, max_await_ms=1000):
+        self._get_collection = get_collection
+        self._listeners = []
+        self._change_listeners = []
+        self._stop_listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._resume_token = None
+        self.retry_delay = retry_delay
+        self.max_await_ms = max_await_ms
+        self.last_event_at = None
+        # When the server last confirmed there were no changes we have not seen
+        self.last_checked_at = None
+        # Set for good once the server says it cannot do change streams
+        self.unsupported = False
+
+    def add_listener(self, listener):
+        """Call `listener(document)` for every inserted document."""
+        self._listeners.append(listener)
+
+    def add_change_listener(self, listener):
+        """Call `listener()` whenever a document is updated, replaced or deleted."""
+        self._change_listeners.append(listener)
+
+    def add_stop_listener(self, listener):
+        """Call `listener()` if the watcher stops because change streams are unsupported."""
+        self._stop_listeners.append(listener)
+
+    def ensure_started(self):
+        """Start the watcher thread unless it is running or can never work."""
+        with self._lock:
+            if self.unsupported or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="change-stream-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def staleness(self):
+        """Seconds since listeners were last known to be up to date, inf if never."""
+        if self.last_checked_at is None:
+            return float("inf")
+        return max(0.0, time.time() - self.last_checked_at)
+
+    def _run(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace",
+                                                          "delete"]}}}]
+        while True:
+            try:
+                with self._get_collection().watch(
+                    pipeline, resume_after=self._resume_token,
+                    max_await_time_ms=self.max_await_ms
+                ) as changes:
+                    # try_next returns None once we have caught up, after at most
+                    # max_await_ms, which keeps last_checked_at fresh on a quiet
+                    # collection. While changes keep coming we are as current as
+                    # the last one we handled.
+                    while changes.alive:
+                        change = changes.try_next()
+                        if change is None:
+                            self.last_checked_at = time.time()
+                            continue
+                        self._resume_token = changes.resume_token
+                        self.last_event_at = time.time()
+                        if change["operationType"] == "insert":
+                            self._dispatch(self._listeners, change["fullDocument"])
+                        else:
+                            self._dispatch(self._change_listeners)
+                        self.last_checked_at = change["clusterTime"].time
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning("Change streams need a replica set, live updates are off")
+                    self.unsupported = True
+                    for listener in self._stop_listeners:
+                        listener()
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    self._resume_token = None
+                logger.warning("Change stream interrupted: %s", str(e))
+                time.sleep(self.retry_delay)
+            except PyMongoError as e:
+                logger.warning("Change stream interrupted: %s", str(e))
+                time.sleep(self.retry_delay)
+
+    def _dispatch(self, listeners, *args):
+        for listener in listeners:
+            try:
+                listener(*args)
+            except Exception as e:  # pylint: disable=broad-except
+                # One broken listener must not stop the others from getting updates
+                logger.error("Change stream listener failed: %s", str(e))
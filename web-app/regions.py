@@ -0,0 +1,279 @@
+"""Offline borough and neighborhood lookup for the NYC Sandwich Price Tracker.
+
+Region polygons are loaded from GeoJSON files in data/ and indexed with a static
+R-tree over their bounding boxes, so finding the region that contains a point only
+runs the exact point-in-polygon test on the few polygons whose boxes match.
+
+The bundled files are the NYC Department of City Planning borough boundaries and
+2010 Neighborhood Tabulation Areas (NTAs), which follow the shoreline, simplified to
+within about 15 meters. Parks, cemeteries and airports have no neighborhood. The
+NYC Open Data "Borough Boundaries" and "Neighborhood Tabulation Areas" GeoJSON
+exports can be dropped in instead, since their property names (boro_name, ntaname,
+boroname) are understood as well.
+"""
+import hashlib
+import json
+import os
+
+from pymongo import UpdateOne
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+NAME_PROPERTIES = ("name", "boro_name", "ntaname")
+BOROUGH_PROPERTIES = ("borough", "boroname", "boro_name")
+
+
+def point_in_ring(x, y, ring):
+    """Ray casting test for a single closed ring of [x, y] points."""
+    inside = False
+    x1, y1 = ring[-1][0], ring[-1][1]
+    for point in ring:
+        x2, y2 = point[0], point[1]
+        if (y2 > y) != (y1 > y) and x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+class Region:
+    """A named area made of one or more polygons, each an outer ring plus holes."""
+
+    def __init__(self, name, polygons, properties=None):
+        self.name = name
+        self.polygons = polygons
+        self.properties = properties or {}
+        xs = [point[0] for polygon in polygons for point in polygon[0]]
+        ys = [point[1] for polygon in polygons for point in polygon[0]]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+
+    def contains(self, x, y):
+        """Exact point-in-polygon test."""
+        for outer, *holes in self.polygons:
+            if point_in_ring(x, y, outer) and not any(point_in_ring(x, y, h) for h in holes):
+                return True
+        return False
+
+
+class _Node:
+    __slots__ = ("bbox", "children", "item")
+
+    def __init__(self, bbox, children=None, item=None):
+        self.bbox = bbox
+        self.children = children
+        self.item = item
+
+
+def _union(nodes):
+    return (
+        min(node.bbox[0] for node in nodes),
+        min(node.bbox[1] for node in nodes),
+        max(node.bbox[2] for node in nodes),
+        max(node.bbox[3] for node in nodes)
+    )
+
+
+class RTree:
+    """Read-only R-tree over bounding boxes, bulk loaded with Sort-Tile-Recursive packing."""
+
+    def __init__(self, entries, node_size=8):
+        """Build the tree from (bbox, item) pairs, bbox being (min_x, min_y, max_x, max_y)."""
+        nodes = [_Node(bbox, item=item) for bbox, item in entries]
+        while len(nodes) > node_size:
+            nodes = self._pack(nodes, node_size)
+        self.root = _Node(_union(nodes), children=nodes) if nodes else None
+
+    @staticmethod
+    def _pack(nodes, node_size):
+        """Group one level of nodes into parents of at most node_size children."""
+        def center(node, axis):
+            return node.bbox[axis] + node.bbox[axis + 2]
+
+        parent_count = -(-len(nodes) // node_size)
+        slice_count = max(1, round(parent_count ** 0.5))
+        slice_size = -(-len(nodes) // slice_count)
+
+        nodes = sorted(nodes, key=lambda node: center(node, 0))
+        parents = []
+        for start in range(0, len(nodes), slice_size):
+            vertical_slice = sorted(nodes[start:start + slice_size],
+                                    key=lambda node: center(node, 1))
+            for group_start in range(0, len(vertical_slice), node_size):
+                group = vertical_slice[group_start:group_start + node_size]
+                parents.append(_Node(_union(group), children=group))
+        return parents
+
+    def query_point(self, x, y):
+        """Yield every item whose bounding box contains the point."""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            min_x, min_y, max_x, max_y = node.bbox
+            if not (min_x <= x <= max_x and min_y <= y <= max_y):
+                continue
+            if node.children is None:
+                yield node.item
+            else:
+                stack.extend(node.children)
+
+    def query_box(self, bbox):
+        """Yield every item whose bounding box intersects bbox."""
+        if self.root is None:
+            return
+        min_x, min_y, max_x, max_y = bbox
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if (node.bbox[0] > max_x or node.bbox[2] < min_x or
+                    node.bbox[1] > max_y or node.bbox[3] < min_y):
+                continue
+            if node.children is None:
+                yield node.item
+            else:
+                stack.extend(node.children)
+
+
+class RegionIndex:
+    """Find which of a set of regions contains a point."""
+
+    def __init__(self, regions):
+        self.regions = regions
+        self._tree = RTree([(region.bbox, (order, region))
+                            for order, region in enumerate(regions)])
+
+    def locate(self, lat, lon, where=None):
+        """Return the region containing (lat, lon), or None.
+
+        If regions overlap the one listed first in the source file wins. `where` can
+        restrict the search to regions it returns True for.
+        """
+        candidates = sorted(self._tree.query_point(lon, lat), key=lambda entry: entry[0])
+        for _, region in candidates:
+            if (where is None or where(region)) and region.contains(lon, lat):
+                return region
+        return None
+
+
+    def intersecting(self, bbox):
+        """Regions whose bounding boxes overlap a (west, south, east, north) box."""
+        return [region for _, region in sorted(self._tree.query_box(bbox),
+                                               key=lambda entry: entry[0])]
+
+
+def _first_property(properties, names):
+    for name in names:
+        if properties.get(name):
+            return properties[name]
+    return None
+
+
+def load_regions(path):
+    """Read Polygon and MultiPolygon features from a GeoJSON file."""
+    with open(path, encoding="utf-8") as f:
+        collection = json.load(f)
+
+    regions = []
+    for feature in collection["features"]:
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+
+        properties = feature.get("properties") or {}
+        regions.append(Region(_first_property(properties, NAME_PROPERTIES), polygons,
+                              {"borough": _first_property(properties, BOROUGH_PROPERTIES)}))
+    return regions
+
+
+def data_version(paths):
+    """Short hash of the region files, which changes whenever they are replaced."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+BOROUGHS_PATH = os.path.join(DATA_DIR, "boroughs.geojson")
+NEIGHBORHOODS_PATH = os.path.join(DATA_DIR, "neighborhoods.geojson")
+BOROUGHS = RegionIndex(load_regions(BOROUGHS_PATH))
+NEIGHBORHOODS = RegionIndex(load_regions(NEIGHBORHOODS_PATH))
+VERSION = data_version([BOROUGHS_PATH, NEIGHBORHOODS_PATH])
+
+
+def locate(lat, lon):
+    """Get the borough and neighborhood for a point, either of which may be None."""
+    borough = BOROUGHS.locate(lat, lon)
+    if borough is None:
+        return {"borough": None, "neighborhood": None}
+
+    neighborhood = NEIGHBORHOODS.locate(
+        lat, lon, where=lambda region: region.properties["borough"] in (None, borough.name)
+    )
+    return {
+        "borough": borough.name,
+        "neighborhood": neighborhood.name if neighborhood else None
+    }
+
+
+def backfill(collection, batch_size=1000):
+    """Tag stored sandwiches that predate borough/neighborhood tagging."""
+    updates = []
+    for sandwich in collection.find({"borough": {"$exists": False}}, {"lat": 1, "lon": 1}):
+        updates.append(UpdateOne({"_id": sandwich["_id"]},
+                                 {"$set": locate(sandwich["lat"], sandwich["lon"])}))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+
+
+def retag(collection, batch_size=1000):
+    """Recompute the borough and neighborhood of every stored sandwich.
+
+    Returns how many changed. The filter repeats the old borough because it is
+    part of the shard key, which MongoDB requires when a write changes it.
+    """
+    updates = []
+    changed = 0
+    for sandwich in collection.find({}, {"lat": 1, "lon": 1, "borough": 1,
+                                         "neighborhood": 1, "geohash": 1}):
+        location = locate(sandwich["lat"], sandwich["lon"])
+        if all(field in sandwich and sandwich[field] == value
+               for field, value in location.items()):
+            continue
+        changed += 1
+        updates.append(UpdateOne({"_id": sandwich["_id"], "borough": sandwich.get("borough"),
+                                  "geohash": sandwich.get("geohash")}, {"$set": location}))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+    return changed
+
+
+def save_version(meta):
+    """Record that stored sandwiches are tagged with the current region files."""
+    meta.update_one({"_id": "regions"}, {"$set": {"version": VERSION}}, upsert=True)
+
+
+def sync_tags(collection, meta):
+    """Retag everything when the region files changed since the last run.
+
+    Otherwise only untagged sandwiches are looked at. Returns how many sandwiches
+    were retagged, or None if the files had not changed.
+    """
+    stored = meta.find_one({"_id": "regions"})
+    if stored is not None and stored.get("version") == VERSION:
+        backfill(collection)
+        return None
+
+    changed = retag(collection)
+    save_version(meta)
+    return changed
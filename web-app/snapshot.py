@@ -0,0 +1,225 @@
+"""Columnar in-memory snapshot of current sandwich prices.
+
+Holds one row per location (the most recently updated price, like
+filter_sandwiches) in NumPy arrays, so city-wide aggregates are computed with
+vectorized operations instead of Python loops over documents.
+"""
+import math
+import threading
+import time
+
+import numpy as np
+
+METERS_PER_DEGREE = 111320
+
+# West, south, east, north edges of the five boroughs
+NYC_BBOX = (-74.26, 40.49, -73.70, 40.92)
+
+
+class SnapshotUnavailable(Exception):
+    """The change stream did not open in time for the snapshot to be loaded."""
+
+
+class PriceSnapshot:
+    """Current price per location, kept in growable NumPy columns.
+
+    With a change stream `watcher`, the bulk load waits until the stream is open so
+    no insert falls between the two. Without change streams (a standalone server)
+    other workers' inserts are never seen, so the snapshot is reloaded every
+    `refresh_s` seconds instead.
+    """
+
+    def __init__(self, load_documents, watcher=None, initial_capacity=1024,
+                 max_cached_grids=32, load_timeout=10, refresh_s=60):
+        self._load_documents = load_documents
+        self._watcher = watcher
+        self.load_timeout = load_timeout
+        self.refresh_s = refresh_s
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._loaded_at = None
+        self._initial_capacity = initial_capacity
+        self._index = {}
+        self._size = 0
+        self._lat = np.empty(initial_capacity)
+        self._lon = np.empty(initial_capacity)
+        self._price = np.empty(initial_capacity)
+        self._updated = [None] * initial_capacity
+        self._grids = {}
+        self._grids_lock = threading.Lock()
+        self._max_cached_grids = max_cached_grids
+        self.version = 0
+
+    def __len__(self):
+        return self._size
+
+    def ensure_loaded(self):
+        """Bulk load every stored price the first time the snapshot is used.
+
+        Raises SnapshotUnavailable if the change stream is not open within
+        load_timeout seconds.
+        """
+        if self._loaded and not self._expired():
+            return
+        self._wait_for_watcher()
+        with self._lock:
+            if self._loaded and not self._expired():
+                return
+            self._clear()
+            for document in self._load_documents():
+                self._add(document)
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+            self.version += 1
+
+    def _wait_for_watcher(self):
+        if self._watcher is None:
+            return
+        self._watcher.ensure_started()
+        deadline = time.monotonic() + self.load_timeout
+        while math.isinf(self._watcher.staleness()) and not self._watcher.unsupported:
+            if time.monotonic() > deadline:
+                raise SnapshotUnavailable("Change stream is not running yet")
+            time.sleep(0.05)
+
+    def _expired(self):
+        return (self._watcher is not None and self._watcher.unsupported and
+                time.monotonic() - self._loaded_at > self.refresh_s)
+
+    def _clear(self):
+        self._index = {}
+        self._size = 0
+        self._lat = np.empty(self._initial_capacity)
+        self._lon = np.empty(self._initial_capacity)
+        self._price = np.empty(self._initial_capacity)
+        self._updated = [None] * self._initial_capacity
+
+    def invalidate(self):
+        """Reload on next use, after a stored price was updated or deleted."""
+        with self._lock:
+            self._loaded = False
+
+    def add(self, document):
+        """Apply one inserted price, keeping only the newest per location."""
+        with self._lock:
+            if self._add(document):
+                self.version += 1
+
+    def _add(self, document):
+        key = (document["lat"], document["lon"])
+        updated = document.get("last_updated")
+        row = self._index.get(key)
+
+        if row is not None:
+            previous = self._updated[row]
+            if previous is not None and updated is not None and previous > updated:
+                return False
+        else:
+            if self._size == len(self._lat):
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._index[key] = row
+            self._lat[row] = document["lat"]
+            self._lon[row] = document["lon"]
+
+        self._price[row] = document["price"]
+        self._updated[row] = updated
+        return True
+
+    def _grow(self):
+        capacity = len(self._lat) * 2
+        for column in ("_lat", "_lon", "_price"):
+            grown = np.empty(capacity)
+            grown[:self._size] = getattr(self, column)[:self._size]
+            setattr(self, column, grown)
+        self._updated.extend([None] * (capacity - len(self._updated)))
+
+    def columns(self):
+        """Copies of the lat, lon and price columns, consistent with each other."""
+        with self._lock:
+            size = self._size
+            return (self._lat[:size].copy(), self._lon[:size].copy(),
+                    self._price[:size].copy(), self.version)
+
+    def heatmap(self, cell_m, bbox=NYC_BBOX):
+        """Count, median and mean price per grid cell of roughly cell_m meters.
+
+        Grids are cached per (cell_m, bbox) until the next price comes in.
+        """
+        self.ensure_loaded()
+        key = (cell_m, bbox)
+        with self._grids_lock:
+            cached = self._grids.get(key)
+        if cached is not None and cached["version"] == self.version:
+            return cached
+
+        lat, lon, price, version = self.columns()
+        grid = compute_heatmap(lat, lon, price, cell_m, bbox)
+        grid["version"] = version
+
+        with self._grids_lock:
+            self._grids.pop(key, None)
+            if len(self._grids) >= self._max_cached_grids:
+                self._grids.pop(next(iter(self._grids)))
+            self._grids[key] = grid
+        return grid
+
+
+def grid_shape(cell_m, bbox):
+    """Cell size in degrees and the number of rows and columns covering bbox."""
+    west, south, east, north = bbox
+    cell_lat = cell_m / METERS_PER_DEGREE
+    cell_lon = cell_m / (METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2)))
+    rows = max(1, math.ceil((north - south) / cell_lat))
+    cols = max(1, math.ceil((east - west) / cell_lon))
+    return cell_lat, cell_lon, rows, cols
+
+
+def compute_heatmap(lat, lon, price, cell_m, bbox):
+    """Bin prices into a grid and aggregate each non-empty cell.
+
+    Only non-empty cells are returned, as parallel lists of cell center lat/lon,
+    count, median and mean price.
+    """
+    west, south, east, north = bbox
+    cell_lat, cell_lon, rows, cols = grid_shape(cell_m, bbox)
+
+    inside = (lat >= south) & (lat < north) & (lon >= west) & (lon < east)
+    lat, lon, price = lat[inside], lon[inside], price[inside]
+
+    row = np.minimum(((lat - south) / cell_lat).astype(np.int64), rows - 1)
+    col = np.minimum(((lon - west) / cell_lon).astype(np.int64), cols - 1)
+    cell = row * cols + col
+
+    # Sort by cell then price so each cell's prices are a sorted run. Packing the
+    # price into the fractional part of one float key is much faster than lexsort
+    if len(price):
+        low, spread = price.min(), np.ptp(price)
+        key = cell + (price - low) / (spread * (1 + 1e-9) + 1e-12)
+        order = np.argsort(key)
+        cell, price = cell[order], price[order]
+
+    starts = np.flatnonzero(np.diff(cell, prepend=-1))
+    counts = np.diff(starts, append=len(cell))
+    occupied = cell[starts]
+    sums = np.add.reduceat(price, starts) if len(price) else np.empty(0)
+    medians = (price[starts + (counts - 1) // 2] + price[starts + counts // 2]) / 2
+
+    center_lat = south + (occupied // cols + 0.5) * cell_lat
+    center_lon = west + (occupied % cols + 0.5) * cell_lon
+
+    return {
+        "bbox": list(bbox),
+        "cell_m": cell_m,
+        "cell_size": {"lat": cell_lat, "lon": cell_lon},
+        "rows": rows,
+        "cols": cols,
+        "cells": {
+            "lat": np.round(center_lat, 6).tolist(),
+            "lon": np.round(center_lon, 6).tolist(),
+            "count": counts.tolist(),
+            "median": np.round(medians, 2).tolist(),
+            "mean": np.round(sums / counts, 2).tolist()
+        }
+    }
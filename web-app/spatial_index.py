@@ -0,0 +1,313 @@
+"""In-process, read-only spatial index of stored sandwich prices.
+
+Every document is kept in memory with its coordinates and price in NumPy arrays
+and its row number filed under a grid cell, so box queries only look at the
+rows of the cells they overlap. The index is bulk loaded once and then kept
+current by the change stream watcher. Inserts are applied as they come, while an
+update or delete throws the index away and reloads it. When the watcher falls
+behind, the index is reloading, or a query uses anything the index does not
+understand, callers go to MongoDB instead.
+"""
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+EARTH_RADIUS_KM = 6371.0
+
+
+class SpatialIndex:
+    """Grid index over NumPy coordinate and price arrays."""
+
+    def __init__(self, load_documents, watcher, enabled=True, max_lag_s=5,
+                 cell_deg=0.01, load_timeout=60, initial_capacity=1024):
+        self._load_documents = load_documents
+        self._watcher = watcher
+        self.enabled = enabled
+        self.max_lag_s = max_lag_s
+        self.cell_deg = cell_deg
+        self.load_timeout = load_timeout
+        self.loaded = False
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reloading = False
+        # Bumped on every invalidation, so a load that started before it is abandoned
+        self._generation = 0
+        self._initial_capacity = initial_capacity
+        self._documents = []
+        self._ids = set()
+        self._cells = defaultdict(list)
+        self._size = 0
+        self._lat = np.empty(initial_capacity)
+        self._lon = np.empty(initial_capacity)
+        self._price = np.empty(initial_capacity)
+        # Boroughs and neighborhoods are stored as small integer codes
+        self._codes = {}
+        self._borough = np.empty(initial_capacity, dtype=np.int32)
+        self._neighborhood = np.empty(initial_capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self._size
+
+    def staleness(self):
+        """Seconds the index may be behind MongoDB."""
+        return self._watcher.staleness()
+
+    def status(self):
+        """Summary for monitoring."""
+        staleness = self.staleness()
+        return {
+            "enabled": self.enabled,
+            "loaded": self.loaded,
+            "size": self._size,
+            "staleness_s": None if math.isinf(staleness) else round(staleness, 3),
+            "serving": self._serving()
+        }
+
+    def _serving(self):
+        return self.enabled and self.loaded and self.staleness() <= self.max_lag_s
+
+    def ensure_started(self):
+        """Load the index in the background the first time it is needed."""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._start, name="spatial-index",
+                                            daemon=True)
+            self._thread.start()
+
+    def _start(self):
+        # The change stream has to be open before the bulk load starts, otherwise
+        # prices inserted in between would be in neither
+        self._watcher.ensure_started()
+        deadline = time.monotonic() + self.load_timeout
+        while math.isinf(self.staleness()):
+            if self._watcher.unsupported or time.monotonic() > deadline:
+                logger.warning("Change stream is not running, spatial index is off")
+                return
+            time.sleep(0.1)
+        try:
+            self.load()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Could not load spatial index: %s", str(e))
+
+    def load(self):
+        """Bulk load every stored document.
+
+        Returns False if the index was invalidated while loading, in which case
+        it stays unloaded.
+        """
+        started = time.time()
+        generation = self._generation
+        for document in self._load_documents():
+            if not self.add(document, generation):
+                return False
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self.loaded = True
+        logger.info("Spatial index loaded %d prices in %.2fs", self._size, time.time() - started)
+        return True
+
+    def invalidate(self):
+        """Drop every document and reload them, after one was updated or deleted."""
+        if not self.enabled or self._thread is None:
+            return
+        with self._lock:
+            self.loaded = False
+            self._generation += 1
+            self._clear()
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, name="spatial-index-reload",
+                         daemon=True).start()
+
+    def _reload(self):
+        while True:
+            generation = self._generation
+            try:
+                self.load()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Could not reload spatial index: %s", str(e))
+            # Start over if there was another update or delete in the meantime
+            with self._lock:
+                if generation == self._generation:
+                    self._reloading = False
+                    return
+
+    def _clear(self):
+        self._documents = []
+        self._ids = set()
+        self._cells = defaultdict(list)
+        self._size = 0
+        self._codes = {}
+        for column in ("_lat", "_lon", "_price", "_borough", "_neighborhood"):
+            old = getattr(self, column)
+            setattr(self, column, np.empty(self._initial_capacity, dtype=old.dtype))
+
+    def add(self, document, generation=None):
+        """Index one inserted document, ignoring ones already indexed.
+
+        Returns False, without adding it, if it comes from a load older than the
+        last invalidation.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            document_id = document.get("_id")
+            if document_id is not None:
+                if document_id in self._ids:
+                    return True
+                self._ids.add(document_id)
+
+            if self._size == len(self._lat):
+                self._grow()
+            row = self._size
+            self._lat[row] = document["lat"]
+            self._lon[row] = document["lon"]
+            self._price[row] = document["price"]
+            self._borough[row] = self._code(document.get("borough"))
+            self._neighborhood[row] = self._code(document.get("neighborhood"))
+            self._cells[self._cell(document["lat"], document["lon"])].append(row)
+            self._documents.append({k: v for k, v in document.items() if k != "_id"})
+            self._size += 1
+        return True
+
+    def _code(self, name):
+        if name not in self._codes:
+            self._codes[name] = len(self._codes)
+        return self._codes[name]
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _grow(self):
+        capacity = len(self._lat) * 2
+        for column in ("_lat", "_lon", "_price", "_borough", "_neighborhood"):
+            old = getattr(self, column)
+            grown = np.empty(capacity, dtype=old.dtype)
+            grown[:self._size] = old[:self._size]
+            setattr(self, column, grown)
+
+    def find(self, query):
+        """Answer a MongoDB-style query from memory.
+
+        Supports range operators on lat, lon and price and equality on borough and
+        neighborhood. Returns None when the query cannot be answered here, either
+        because the index is disabled or stale or because the query uses anything
+        else, and the caller should ask MongoDB instead.
+        """
+        if not self._serving():
+            return None
+        for field, condition in query.items():
+            if field in ("lat", "lon", "price"):
+                if not isinstance(condition, dict) or not set(condition) <= RANGE_OPERATORS:
+                    return None
+            elif field in ("borough", "neighborhood"):
+                if not isinstance(condition, str):
+                    return None
+            else:
+                return None
+
+        with self._lock:
+            rows = self._candidate_rows(query.get("lat"), query.get("lon"))
+            mask = np.ones(len(rows), dtype=bool)
+            for field, column in (("lat", self._lat), ("lon", self._lon),
+                                  ("price", self._price)):
+                for operator, value in query.get(field, {}).items():
+                    mask &= compare(column[rows], operator, value)
+            for field, column in (("borough", self._borough),
+                                  ("neighborhood", self._neighborhood)):
+                if field in query:
+                    mask &= column[rows] == self._codes.get(query[field], -1)
+            return [dict(self._documents[row]) for row in rows[mask]]
+
+    def _candidate_rows(self, lat_range, lon_range):
+        """Rows in the grid cells overlapping a lat/lon box, or every row."""
+        if not lat_range or not lon_range:
+            return np.arange(self._size)
+
+        lat_low, lat_high = bounds(lat_range)
+        lon_low, lon_high = bounds(lon_range)
+        if math.isinf(lat_low + lat_high + lon_low + lon_high):
+            return np.arange(self._size)
+
+        (row_low, col_low), (row_high, col_high) = (self._cell(lat_low, lon_low),
+                                                    self._cell(lat_high, lon_high))
+        if (row_high - row_low + 1) * (col_high - col_low + 1) > len(self._cells):
+            return np.arange(self._size)
+
+        rows = []
+        for cell_row in range(row_low, row_high + 1):
+            for cell_col in range(col_low, col_high + 1):
+                rows.extend(self._cells.get((cell_row, cell_col), ()))
+        return np.array(sorted(rows), dtype=np.int64)
+
+
+def bounds(condition):
+    """Lowest and highest value a range condition can match."""
+    low = max([condition[op] for op in ("$gt", "$gte") if op in condition], default=-math.inf)
+    high = min([condition[op] for op in ("$lt", "$lte") if op in condition], default=math.inf)
+    return low, high
+
+
+def compare(column, operator, value):
+    """Vectorized version of a MongoDB range operator."""
+    if operator == "$gt":
+        return column > value
+    if operator == "$gte":
+        return column >= value
+    if operator == "$lt":
+        return column < value
+    return column <= value
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km, broadcasting over NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def nearby_matches(points, candidates, max_cells=2000000):
+    """Candidates in each (lat, lon, radius) point's box, sorted by haversine distance.
+
+    Distance matrices are computed in slices of about max_cells point/candidate
+    pairs, so memory use stays bounded however many points are asked for.
+    """
+    if not candidates:
+        return [[] for _ in points]
+
+    deli_lat = np.array([c["lat"] for c in candidates], dtype=float)
+    deli_lon = np.array([c["lon"] for c in candidates], dtype=float)
+    point_lat, point_lon, point_radius = (np.array(column, dtype=float)
+                                          for column in zip(*points))
+
+    results = []
+    step = max(1, max_cells // len(candidates))
+    for start in range(0, len(points), step):
+        lat = point_lat[start:start + step, None]
+        lon = point_lon[start:start + step, None]
+        half = 0.01 * point_radius[start:start + step, None]
+        in_box = (np.abs(deli_lat - lat) < half) & (np.abs(deli_lon - lon) < half)
+        distances = haversine_km(lat, lon, deli_lat, deli_lon)
+
+        for row_in_box, row_distances in zip(in_box, distances):
+            matches = np.flatnonzero(row_in_box)
+            matches = matches[np.argsort(row_distances[matches], kind="stable")]
+            results.append([{**candidates[i], "distance": float(row_distances[i])}
+                            for i in matches])
+    return results
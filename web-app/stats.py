@@ -0,0 +1,372 @@
+"""Streaming price statistics for the NYC Sandwich Price Tracker.
+
+Every price observation is added to a t-digest quantile sketch for each region it
+falls in (all of NYC, its borough and its neighborhood) and for the day it was
+recorded. Sketches are mergeable, so answering "median price in Brooklyn this
+month" only merges one small sketch per region and day instead of reading every
+observation.
+
+Each worker process keeps cumulative sketches for its own inserts, and a background
+thread upserts them into MongoDB under its own worker id. Workers never write each other's
+documents, so there are no lost updates, and queries merge all workers' sketches.
+Days that can no longer change are compacted into one document per region, so
+queries do not slow down as processes come and go.
+"""
+import logging
+import math
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+ALL_REGIONS = "NYC"
+
+# Worker id of compacted sketches, and of the document that makes sure only one
+# worker compacts at a time
+COMPACTED = "compacted"
+COMPACTION_LEASE = "compaction-lease"
+
+
+class TDigest:
+    """Merging t-digest (Dunning & Ertl) for approximate quantiles.
+
+    Accuracy is best near the tails and the sketch never holds more than about
+    `compression` centroids, whatever the number of values added.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer_means = []
+        self._buffer_weights = []
+
+    def add(self, value, weight=1):
+        """Add one observation."""
+        self._buffer_means.append(value)
+        self._buffer_weights.append(weight)
+        self.count += weight
+        self.total += value * weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer_means) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        """Fold another digest into this one."""
+        other._compress()
+        self._buffer_means.extend(other.means.tolist())
+        self._buffer_weights.extend(other.weights.tolist())
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def _k(self, q):
+        """k1 scale function, which keeps centroids small near q=0 and q=1."""
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k):
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer_means:
+            return
+
+        means = np.concatenate((self.means, self._buffer_means))
+        weights = np.concatenate((self.weights, self._buffer_weights))
+        self._buffer_means = []
+        self._buffer_weights = []
+
+        order = np.argsort(means, kind="mergesort")
+        means, weights = means[order].tolist(), weights[order].tolist()
+        total_weight = sum(weights)
+
+        merged_means = [means[0]]
+        merged_weights = [weights[0]]
+        seen = 0.0
+        limit = total_weight * self._k_inverse(self._k(0) + 1)
+        for mean, weight in zip(means[1:], weights[1:]):
+            if seen + merged_weights[-1] + weight <= limit:
+                merged_weight = merged_weights[-1] + weight
+                merged_means[-1] += (mean - merged_means[-1]) * weight / merged_weight
+                merged_weights[-1] = merged_weight
+            else:
+                seen += merged_weights[-1]
+                limit = total_weight * self._k_inverse(self._k(seen / total_weight) + 1)
+                merged_means.append(mean)
+                merged_weights.append(weight)
+
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def quantile(self, q):
+        """Estimate the q-th quantile (0 <= q <= 1), or None if the digest is empty."""
+        self._compress()
+        if self.count == 0:
+            return None
+        if len(self.means) == 1:
+            return float(self.means[0])
+
+        target = q * self.count
+        centers = np.cumsum(self.weights) - self.weights / 2
+        if target <= centers[0]:
+            return float(self.min + (self.means[0] - self.min) * target / centers[0])
+        if target >= centers[-1]:
+            tail = self.count - centers[-1]
+            return float(self.means[-1] + (self.max - self.means[-1]) *
+                         (target - centers[-1]) / tail)
+
+        i = int(np.searchsorted(centers, target))
+        fraction = (target - centers[i - 1]) / (centers[i] - centers[i - 1])
+        return float(self.means[i - 1] + (self.means[i] - self.means[i - 1]) * fraction)
+
+    def to_dict(self):
+        """Serialize for storage in MongoDB."""
+        self._compress()
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a digest saved with to_dict."""
+        digest = cls(data["compression"])
+        digest.means = np.array(data["means"], dtype=float)
+        digest.weights = np.array(data["weights"], dtype=float)
+        digest.count = data["count"]
+        digest.total = data["total"]
+        digest.min = data["min"]
+        digest.max = data["max"]
+        return digest
+
+
+def day_bucket(moment):
+    """Start of the day a timestamp falls in, which is the time bucket for sketches."""
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def sandwich_regions(sandwich):
+    """Every region a sandwich counts towards."""
+    return [ALL_REGIONS] + [sandwich[field] for field in ("borough", "neighborhood")
+                            if sandwich.get(field)]
+
+
+class PriceStats:
+    """Per region and day price sketches, shared between workers through MongoDB."""
+
+    def __init__(self, get_collection, worker_id=None, flush_interval=5, compression=100,
+                 compact_interval=3600):
+        self._get_collection = get_collection
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._thread = None
+        # Cumulative sketches, and what was added to each since it was last saved
+        self._sketches = {}
+        self._unsaved = {}
+        # Unsaved additions to days that may already be compacted, as
+        # (document id, region, bucket, digest), retried as they are
+        self._late = []
+        self._last_compaction = None
+
+    def record(self, sandwich):
+        """Add one price observation, to be saved by the background thread."""
+        bucket = day_bucket(sandwich.get("last_updated") or datetime.now())
+        with self._lock:
+            for region in sandwich_regions(sandwich):
+                key = (region, bucket)
+                for sketches in (self._sketches, self._unsaved):
+                    if key not in sketches:
+                        sketches[key] = TDigest(self.compression)
+                    sketches[key].add(sandwich["price"])
+        self.ensure_started()
+
+    def ensure_started(self):
+        """Start the thread that flushes every flush_interval seconds, unless it is running."""
+        if math.isinf(self.flush_interval):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="price-stats", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Saving and compacting talk to MongoDB, so they stay off the request path
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                due = (self._last_compaction is None or
+                       time.monotonic() - self._last_compaction >= self.compact_interval)
+                if due and not math.isinf(self.compact_interval):
+                    self._last_compaction = time.monotonic()
+                    self.compact()
+            except PyMongoError as e:
+                logger.error("Could not save price statistics: %s", str(e))
+
+    def flush(self):
+        """Upsert this worker's changed sketches.
+
+        Today's and yesterday's sketches are saved whole under this worker's id.
+        Older days may have been compacted already, so what was added to them since
+        the last save goes into a document of its own.
+        """
+        cutoff = day_bucket(datetime.now()) - timedelta(days=1)
+        with self._lock:
+            unsaved = self._unsaved
+            self._unsaved = {}
+            saved = []
+            for (region, bucket), added in unsaved.items():
+                if bucket >= cutoff:
+                    saved.append((f"{self.worker_id}:{region}:{bucket:%Y-%m-%d}", region,
+                                  bucket, self._sketches[(region, bucket)]))
+                else:
+                    self._late.append((f"{self.worker_id}:{region}:{bucket:%Y-%m-%d}:"
+                                       f"{uuid.uuid4().hex}", region, bucket, added))
+            late = self._late
+            self._late = []
+            writes = [
+                ReplaceOne({"_id": document_id}, {
+                    "region": region,
+                    "bucket": bucket,
+                    "worker": self.worker_id,
+                    "digest": digest.to_dict()
+                }, upsert=True)
+                for document_id, region, bucket, digest in saved + late
+            ]
+
+        if writes:
+            try:
+                self._get_collection().bulk_write(writes, ordered=False)
+            except PyMongoError:
+                # Cumulative sketches lose nothing by being written again next time.
+                # Late documents are retried unchanged, so if one was saved and
+                # compacted after all, the copy is recognized as already merged.
+                with self._lock:
+                    for key, added in unsaved.items():
+                        if key[1] >= cutoff:
+                            if key in self._unsaved:
+                                added.merge(self._unsaved[key])
+                            self._unsaved[key] = added
+                    self._late = late + self._late
+                raise
+
+        # Inserts are stamped with the current time, so sketches from before
+        # yesterday will not change again and can be dropped from memory
+        with self._lock:
+            self._sketches = {key: sketch for key, sketch in self._sketches.items()
+                              if key[1] >= cutoff or key in self._unsaved}
+
+    def compact(self):
+        """Merge all workers' sketches for days before the day before yesterday.
+
+        Workers stop rewriting a day's sketches once it is over, and the extra day
+        covers flushes that were underway at midnight. The compacted
+        document lists the documents merged into it, so if the deletes never happen
+        queries still skip them. Returns the number of (region, day) pairs compacted,
+        or None if another worker holds the compaction lease.
+        """
+        collection = self._get_collection()
+        now = datetime.now()
+        try:
+            collection.find_one_and_update(
+                {"_id": COMPACTION_LEASE, "expires": {"$lt": now}},
+                {"$set": {"expires": now + timedelta(minutes=10), "worker": self.worker_id}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return None
+
+        cutoff = day_bucket(now) - timedelta(days=2)
+        groups = {}
+        for document in collection.find({"bucket": {"$lt": cutoff},
+                                         "worker": {"$ne": COMPACTED}},
+                                        {"region": 1, "bucket": 1, "digest": 1}):
+            groups.setdefault((document["region"], document["bucket"]), []).append(document)
+
+        for (region, bucket), documents in groups.items():
+            compacted_id = f"{COMPACTED}:{region}:{bucket:%Y-%m-%d}"
+            compacted = collection.find_one({"_id": compacted_id})
+            merged = (TDigest.from_dict(compacted["digest"]) if compacted
+                      else TDigest(self.compression))
+            sources = compacted["sources"] if compacted else []
+            for document in documents:
+                if document["_id"] not in sources:
+                    merged.merge(TDigest.from_dict(document["digest"]))
+                    sources.append(document["_id"])
+
+            collection.replace_one({"_id": compacted_id}, {
+                "region": region,
+                "bucket": bucket,
+                "worker": COMPACTED,
+                "digest": merged.to_dict(),
+                "sources": sources
+            }, upsert=True)
+            collection.delete_many({"_id": {"$in": [d["_id"] for d in documents]}})
+
+        collection.delete_one({"_id": COMPACTION_LEASE, "worker": self.worker_id})
+        return len(groups)
+
+    def query(self, regions, start=None, end=None):
+        """Merge the stored sketches for the regions and days in [start, end].
+
+        Only reads, so this worker's latest prices show up once its background
+        thread flushes them, within flush_interval seconds.
+        """
+        query = {"region": {"$in": regions}}
+        if start or end:
+            query["bucket"] = {}
+            if start:
+                query["bucket"]["$gte"] = day_bucket(start)
+            if end:
+                query["bucket"]["$lte"] = end
+
+        documents = list(self._get_collection().find(query, {"digest": 1, "sources": 1}))
+        # Already part of a compacted sketch, but not deleted yet
+        merged_ids = {source for document in documents
+                      for source in document.get("sources", ())}
+
+        merged = TDigest(self.compression)
+        for document in documents:
+            if document["_id"] not in merged_ids:
+                merged.merge(TDigest.from_dict(document["digest"]))
+        return merged
+
+    def rebuild(self, sandwiches):
+        """Replace all stored sketches with ones computed from every observation.
+
+        Run this while no prices are being added, since other workers' in-memory
+        sketches would otherwise be written back on top of the rebuilt ones.
+        """
+        rebuilt = PriceStats(self._get_collection, worker_id="rebuild",
+                             flush_interval=math.inf, compression=self.compression,
+                             compact_interval=math.inf)
+        count = 0
+        for sandwich in sandwiches:
+            rebuilt.record(sandwich)
+            count += 1
+
+        self._get_collection().delete_many({})
+        rebuilt.flush()
+        return count
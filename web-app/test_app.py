@@ -23,6 +23,8 @@ class AppTestCase(unittest.TestCase):
         # Create a mock collection
         cls.mock_collection = MagicMock()
         cls.mock_mongo.return_value.__getitem__.return_value.__getitem__.return_value = cls.mock_collection
+        # Reads go through with_options() for replica-set routing
+        cls.mock_collection.with_options.return_value = cls.mock_collection
         
         # Now import app after patching
         import app
@@ -35,6 +37,8 @@ class AppTestCase(unittest.TestCase):
         app.COLLECTION_HELPER = cls.mock_collection
         
         cls.app = app.app
+        # Rate limits are covered by their own tests, the others should not trip them
+        app.ADMISSION.enabled = False
         # Also make the collection available to the test class to patch in individual tests
         cls.app_module = app
         cls.get_marker_color = get_marker_color
@@ -258,6 +262,7 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(call_args['name'], 'New Deli')
         self.assertEqual(call_args['address'], '456 New St, Brooklyn, New York, NY 10001, United States')
         self.assertEqual(call_args['price'], 6.99)
+        self.assertEqual(call_args['borough'], 'Manhattan')
         
         # Test error case - insufficient data
         incomplete_data = {
@@ -485,5 +490,1098 @@ class AppTestCase(unittest.TestCase):
         # Makes sure most recent entry is shown
         self.assertEqual(test_deli_1["price"], 7.00)
 
+    def test_read_collection_prefers_secondaries(self):
+        """Test that reads are routed with secondaryPreferred and a staleness bound."""
+        self.app_module.read_collection()
+        kwargs = self.mock_collection.with_options.call_args[1]
+        read_preference = kwargs["read_preference"]
+        self.assertEqual(read_preference.mongos_mode, "secondaryPreferred")
+        self.assertEqual(read_preference.max_staleness, self.app_module.MONGO_MAX_STALENESS_S)
+
+    @patch('app.geocode_address')
+    def test_add_then_home_reads_own_write(self, mock_geocode):
+        """Test that the redirect after /add reads through a causally consistent session."""
+        from bson.timestamp import Timestamp
+
+        mock_geocode.return_value = {
+            "lat": 40.7128,
+            "lon": -74.0060,
+            "display_name": "123 Test St, New York, NY, USA"
+        }
+        write_session = MagicMock()
+        write_session.operation_time = Timestamp(1700000000, 1)
+        write_session.cluster_time = {"clusterTime": Timestamp(1700000000, 1)}
+        read_session = MagicMock()
+        start_session = self.app_module.CLIENT.start_session
+        start_session.reset_mock()
+        start_session.return_value.__enter__.side_effect = [write_session, read_session]
+        self.mock_collection.find.return_value = []
+
+        try:
+            response = self.client.post('/add', data={
+                "name": "New Test Deli",
+                "address": "123 Test St",
+                "price": "6.99"
+            }, follow_redirects=True)
+            response.get_data()
+        finally:
+            start_session.return_value.__enter__.side_effect = None
+
+        self.assertEqual(response.status_code, 200)
+        start_session.assert_called_with(causal_consistency=True)
+        read_session.advance_operation_time.assert_called_once_with(Timestamp(1700000000, 1))
+        read_session.advance_cluster_time.assert_called_once_with(
+            {"clusterTime": Timestamp(1700000000, 1)}
+        )
+        self.assertIs(self.mock_collection.find.call_args[1]["session"], read_session)
+
+    def test_home_drops_expired_causal_token(self):
+        """Test that an expired causal token is removed from the cookie of a streamed page."""
+        from bson import json_util
+        from bson.timestamp import Timestamp
+
+        token = json_util.dumps({
+            "operation_time": Timestamp(1700000000, 1),
+            "cluster_time": {"clusterTime": Timestamp(1700000000, 1)},
+            "written_at": 0
+        }, json_options=json_util.CANONICAL_JSON_OPTIONS)
+        with self.client.session_transaction() as sess:
+            sess["causal_token"] = token
+        self.mock_collection.find.return_value = []
+
+        response = self.client.get('/')
+        response.get_data()
+
+        with self.client.session_transaction() as sess:
+            self.assertNotIn("causal_token", sess)
+
+    def test_broadcast_hub_resets_slow_clients(self):
+        """Test that a client with a full buffer gets a reset and is dropped."""
+        from live_updates import BroadcastHub
+
+        hub = BroadcastHub(buffer_size=2)
+        fast = hub.subscribe()
+        slow = hub.subscribe()
+        hub.publish("price", {"price": 5.99})
+        fast.get_nowait()
+        hub.publish("price", {"price": 6.50})
+        hub.publish("price", {"price": 7.25})
+
+        self.assertEqual(len(hub), 1)
+        self.assertEqual(slow.get_nowait(), ("reset", None))
+        self.assertTrue(slow.empty())
+        self.assertEqual(fast.get_nowait(), ("price", {"price": 6.50}))
+        self.assertEqual(fast.get_nowait(), ("price", {"price": 7.25}))
+
+    def test_stream_api(self):
+        """Test that /api/stream sends new prices as Server-Sent Events."""
+        with patch.object(self.app_module.WATCHER, 'ensure_started') as mock_start:
+            response = self.client.get('/api/stream')
+            mock_start.assert_called_once()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+
+        self.app_module.WATCHER._dispatch(self.app_module.WATCHER._listeners,
+                                         self.test_sandwiches[0])
+        chunks = response.response
+        self.assertEqual(next(chunks), b"retry: 5000\n\n")
+        message = next(chunks).decode()
+        response.close()
+
+        self.assertTrue(message.startswith("event: price\ndata: "))
+        data = json.loads(message.split("data: ", 1)[1])
+        self.assertEqual(data["name"], "Test Deli 1")
+        self.assertEqual(data["color"], "#4CAF50")
+        self.assertEqual(len(self.app_module.HUB), 0)
+
+    def test_watcher_stops_for_good_without_change_streams(self):
+        """Test that a standalone server stops the watcher and live update clients."""
+        from pymongo.errors import OperationFailure
+        from live_updates import BroadcastHub, ChangeStreamWatcher
+
+        collection = MagicMock()
+        collection.watch.side_effect = OperationFailure("not a replica set", code=40573)
+        hub = BroadcastHub()
+        subscriber = hub.subscribe()
+        watcher = ChangeStreamWatcher(lambda: collection)
+        watcher.add_stop_listener(hub.close_all)
+
+        watcher._run()
+        self.assertTrue(watcher.unsupported)
+        self.assertEqual(list(hub.stream(subscriber, heartbeat=1))[-1],
+                         "event: end\ndata: null\n\n")
+        self.assertEqual(len(hub), 0)
+
+        with patch('threading.Thread') as thread:
+            watcher.ensure_started()
+            thread.assert_not_called()
+
+        with patch.object(self.app_module.WATCHER, 'unsupported', True), \
+                patch.object(self.app_module.WATCHER, 'ensure_started'):
+            response = self.client.get('/api/stream')
+            self.assertEqual(response.status_code, 204)
+
+    def test_build_assets_fingerprints_and_compresses(self):
+        """Test that the asset build hashes names, fixes CSS urls and precompresses."""
+        import tempfile
+        import build_assets
+
+        with tempfile.TemporaryDirectory() as static_dir:
+            os.makedirs(os.path.join(static_dir, "vendor", "images"))
+            with open(os.path.join(static_dir, "vendor", "images", "icon.png"), "wb") as f:
+                f.write(b"not really a png")
+            with open(os.path.join(static_dir, "vendor", "site.css"), "w") as f:
+                f.write(".icon { background: url(images/icon.png); }\n" * 50)
+
+            manifest = build_assets.build(static_dir)
+
+            css = manifest["vendor/site.css"]
+            icon = manifest["vendor/images/icon.png"]
+            self.assertRegex(css, r"^vendor/site\.[0-9a-f]{10}\.css$")
+            dist_dir = os.path.join(static_dir, "dist")
+            with open(os.path.join(dist_dir, css)) as f:
+                self.assertIn(f"url({icon[len('vendor/'):]})", f.read())
+            self.assertTrue(os.path.isfile(os.path.join(dist_dir, css + ".gz")))
+            self.assertFalse(os.path.isfile(os.path.join(dist_dir, icon + ".gz")))
+            with open(os.path.join(dist_dir, "manifest.json")) as f:
+                self.assertEqual(json.load(f), manifest)
+
+    def test_vendored_assets_are_pinned(self):
+        """Test that vendored downloads are checked and the page falls back to the CDN."""
+        import tempfile
+        import build_assets
+
+        path = "vendor/leaflet/leaflet.js"
+        url, sha256 = build_assets.VENDOR_ASSETS[path]
+        with tempfile.TemporaryDirectory() as static_dir, \
+                patch.object(build_assets, 'VENDOR_ASSETS', {path: (url, sha256)}), \
+                patch('build_assets.requests.get') as mock_get:
+            mock_get.return_value.content = b"alert('tampered')"
+            with self.assertRaises(ValueError):
+                build_assets.vendor_assets(static_dir)
+            self.assertFalse(os.path.exists(os.path.join(static_dir, path)))
+
+        with patch.object(self.app_module, 'ASSET_MANIFEST', {}), \
+                self.app.test_request_context('/'):
+            self.assertEqual(self.app_module.asset_url(path), url)
+            self.assertEqual(self.app_module.asset_url("styles.css"), "/static/styles.css")
+
+    def test_serve_asset_immutable_and_precompressed(self):
+        """Test that fingerprinted assets are cached forever and negotiate encoding."""
+        import gzip
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as dist_dir:
+            with open(os.path.join(dist_dir, "styles.0123456789.css"), "wb") as f:
+                f.write(b"body { margin: 0; }")
+            with open(os.path.join(dist_dir, "styles.0123456789.css.gz"), "wb") as f:
+                f.write(gzip.compress(b"body { margin: 0; }"))
+
+            with patch.object(self.app_module, 'ASSET_DIST_DIR', dist_dir), \
+                    patch.dict(self.app_module.ASSET_MANIFEST,
+                               {"styles.css": "styles.0123456789.css"}):
+                with self.app.test_request_context():
+                    url = self.app_module.asset_url("styles.css")
+                self.assertEqual(url, "/assets/styles.0123456789.css")
+
+                response = self.client.get(url, headers={"Accept-Encoding": "gzip, br"})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertEqual(response.mimetype, "text/css")
+                self.assertIn("immutable", response.headers["Cache-Control"])
+                self.assertIn("Accept-Encoding", response.headers["Vary"])
+                self.assertEqual(gzip.decompress(response.data), b"body { margin: 0; }")
+                response.close()
+
+                response = self.client.get(url, headers={"Accept-Encoding": "identity"})
+                self.assertNotIn("Content-Encoding", response.headers)
+                self.assertEqual(response.data, b"body { margin: 0; }")
+                response.close()
+
+                response = self.client.get("/assets/../app.py")
+                self.assertEqual(response.status_code, 404)
+
+    def test_home_streams_compact_markers(self):
+        """Test that the map is streamed with markers embedded as one JSON array."""
+        sandwiches = self.test_sandwiches[:2] + [{
+            "name": "</script><script>alert(1)</script>",
+            "address": "1 Evil St",
+            "lat": 40.75,
+            "lon": -73.99,
+            "price": 8.5,
+            "last_updated": datetime.datetime.now()
+        }]
+        self.mock_collection.find.return_value = sandwiches
+
+        with patch.object(self.app_module, 'MARKER_CHUNK_SIZE', 2):
+            response = self.client.get('/')
+            self.assertTrue(response.is_streamed)
+            page = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        array = page.split("const sandwiches = ", 1)[1].split(";\n", 1)[0]
+        rows = json.loads(array)
+        self.assertEqual(rows[0], [40.7128, -74.006, 5.99, "Test Deli 1",
+                                   "123 Test St, New York, NY"])
+        self.assertEqual(len(rows), 3)
+        self.assertNotIn("<script>alert(1)", page)
+        self.assertEqual(page.count("L.circleMarker("), 1)
+
+    def test_home_renders_without_database(self):
+        """Test that the streamed page still closes the marker array if MongoDB fails."""
+        from pymongo.errors import ServerSelectionTimeoutError
+
+        self.mock_collection.find.side_effect = ServerSelectionTimeoutError("no servers")
+        self.addCleanup(setattr, self.mock_collection.find, 'side_effect', None)
+        page = self.client.get('/').get_data(as_text=True)
+        self.assertIn("const sandwiches = [];", page)
+        self.assertIn("</html>", page)
+
+        with patch.object(self.app_module, 'COLLECTION', None):
+            page = self.client.get('/').get_data(as_text=True)
+        self.assertIn("const sandwiches = [];", page)
+        self.assertIn("</html>", page)
+
+    def test_memory_token_bucket(self):
+        """Test that the in-memory token bucket allows bursts and then refills."""
+        from admission import MemoryRateLimitStore
+
+        now = [100.0]
+        store = MemoryRateLimitStore(clock=lambda: now[0])
+        self.assertEqual(store.take("client", rate=1, burst=2), (True, 0))
+        self.assertEqual(store.take("client", rate=1, burst=2), (True, 0))
+        allowed, retry_after = store.take("client", rate=1, burst=2)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 1)
+        self.assertTrue(store.take("other-client", rate=1, burst=2)[0])
+
+        now[0] += 1.5
+        self.assertTrue(store.take("client", rate=1, burst=2)[0])
+        self.assertFalse(store.take("client", rate=1, burst=2)[0])
+
+        # Pruning for a fast route keeps a slow route's half empty bucket
+        store = MemoryRateLimitStore(clock=lambda: now[0], max_keys=1)
+        for _ in range(3):
+            store.take("add:client", rate=0.2, burst=5)
+        now[0] += 11
+        store.take("search:client", rate=1, burst=10)
+        self.assertIn("add:client", store._buckets)
+        now[0] += 5
+        store.take("search:other", rate=1, burst=10)
+        self.assertNotIn("add:client", store._buckets)
+
+    def test_mongo_token_bucket(self):
+        """Test that the MongoDB token bucket is a single atomic upsert."""
+        from admission import MongoRateLimitStore
+
+        collection = MagicMock()
+        collection.find_one_and_update.return_value = {"allowed": False, "tokens": 0.5}
+        store = MongoRateLimitStore(lambda: collection)
+
+        allowed, retry_after = store.take("search:127.0.0.1", rate=2, burst=10)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.25)
+        args, kwargs = collection.find_one_and_update.call_args
+        self.assertEqual(args[0], {"_id": "search:127.0.0.1"})
+        self.assertTrue(kwargs["upsert"])
+
+        # An unreachable store lets requests through instead of failing them
+        from flask import Flask
+        from pymongo.errors import ServerSelectionTimeoutError
+        from admission import AdmissionController
+
+        collection.find_one_and_update.side_effect = ServerSelectionTimeoutError("down")
+        limited_app = Flask(__name__)
+
+        @limited_app.route("/limited")
+        @AdmissionController(store).limit("limited", concurrency=1, rate=1, burst=1,
+                                          queue_budget=1)
+        def limited():
+            return "ok"
+
+        self.assertEqual(limited_app.test_client().get("/limited").status_code, 200)
+
+    def test_admission_control_sheds_and_rate_limits(self):
+        """Test 429 on exhausted tokens and 503 when the queue budget runs out."""
+        import threading
+        import time
+        from flask import Flask
+        from admission import AdmissionController, MemoryRateLimitStore
+
+        limited_app = Flask(__name__)
+        controller = AdmissionController(MemoryRateLimitStore())
+        release = threading.Event()
+
+        @limited_app.route("/api/slow")
+        @controller.limit("slow", concurrency=1, rate=100, burst=100, queue_budget=0.1)
+        def slow():
+            release.wait(5)
+            return "done"
+
+        @limited_app.route("/strict")
+        @controller.limit("strict", concurrency=5, rate=0.01, burst=1, queue_budget=1)
+        def strict():
+            return "ok"
+
+        client = limited_app.test_client()
+        self.assertEqual(client.get("/strict").status_code, 200)
+        response = client.get("/strict")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertEqual(response.headers["Retry-After"], "100")
+
+        worker = threading.Thread(target=lambda: client.get("/api/slow").close())
+        worker.start()
+        time.sleep(0.2)
+        response = limited_app.test_client().get("/api/slow")
+        release.set()
+        worker.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("error", response.get_json())
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+        # The slot is free again once the first response was closed
+        response = client.get("/api/slow")
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        # Requests that already waited too long upstream are shed straight away
+        response = client.get("/api/slow",
+                              headers={"X-Request-Start": f"t={int((time.time() - 5) * 1000)}"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_rate_limits_per_client_behind_proxy(self):
+        """Test that rate limit keys come from X-Forwarded-For only for trusted proxies."""
+        from flask import Flask
+        from admission import AdmissionController, MemoryRateLimitStore, client_address
+
+        limited_app = Flask(__name__)
+        headers = {"X-Forwarded-For": "6.6.6.6, 203.0.113.7, 10.0.0.2"}
+        with limited_app.test_request_context(headers=headers,
+                                              environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+            self.assertEqual(client_address(), "10.0.0.1")
+            self.assertEqual(client_address(1), "10.0.0.2")
+            self.assertEqual(client_address(2), "203.0.113.7")
+            self.assertEqual(client_address(4), "10.0.0.1")
+
+        controller = AdmissionController(MemoryRateLimitStore(), trusted_proxies=1)
+
+        @limited_app.route("/strict")
+        @controller.limit("strict", concurrency=5, rate=0.01, burst=1, queue_budget=1)
+        def strict():
+            return "ok"
+
+        client = limited_app.test_client()
+        proxy = {"REMOTE_ADDR": "10.0.0.1"}
+        for address in ("203.0.113.7", "203.0.113.8"):
+            response = client.get("/strict", headers={"X-Forwarded-For": address},
+                                  environ_base=proxy)
+            self.assertEqual(response.status_code, 200)
+        # A forged entry in front of the real one does not get a fresh bucket
+        response = client.get("/strict", headers={"X-Forwarded-For": "1.2.3.4, 203.0.113.7"},
+                              environ_base=proxy)
+        self.assertEqual(response.status_code, 429)
+
+    def test_locate_borough_and_neighborhood(self):
+        """Test offline borough and neighborhood lookup."""
+        import regions
+
+        self.assertEqual(regions.locate(40.755, -73.978),
+                         {"borough": "Manhattan", "neighborhood": "Midtown-Midtown South"})
+        self.assertEqual(regions.locate(40.714, -73.961),
+                         {"borough": "Brooklyn", "neighborhood": "North Side-South Side"})
+        cases = {
+            # Waterfront and city line neighborhoods
+            (40.7033, -73.9881): ("Brooklyn", "DUMBO-Vinegar Hill-Downtown Brooklyn-Boerum Hill"),
+            (40.6437, -74.0736): ("Staten Island", "West New Brighton-New Brighton-St. George"),
+            (40.7630, -73.7320): ("Queens", "Douglas Manor-Douglaston-Little Neck"),
+            (40.7470, -73.7110): ("Queens", "Glen Oaks-Floral Park-New Hyde Park"),
+            (40.6755, -74.0110): ("Brooklyn", "Carroll Gardens-Columbia Street-Red Hook"),
+            (40.6264, -74.0299): ("Brooklyn", "Bay Ridge"),
+            (40.8100, -73.9625): ("Manhattan", "Morningside Heights"),
+            (40.8094, -73.8803): ("Bronx", "Hunts Point"),
+            # Either side of the Brooklyn-Queens line
+            (40.7043, -73.9018): ("Queens", "Ridgewood"),
+            (40.6990, -73.9110): ("Brooklyn", "Bushwick North"),
+            (40.7433, -73.9196): ("Queens", "Hunters Point-Sunnyside-West Maspeth"),
+            (40.7377, -73.9570): ("Brooklyn", "Greenpoint"),
+            # Marble Hill is Manhattan on the Bronx side of the river
+            (40.8762, -73.9104): ("Manhattan", "Marble Hill-Inwood"),
+            (40.8800, -73.9200): ("Bronx", "Spuyten Duyvil-Kingsbridge"),
+            # Parks have a borough but no neighborhood
+            (40.7932, -73.9213): ("Manhattan", None),
+        }
+        for (lat, lon), (borough, neighborhood) in cases.items():
+            self.assertEqual(regions.locate(lat, lon),
+                             {"borough": borough, "neighborhood": neighborhood}, (lat, lon))
+        # Jersey City and Nassau County are not part of NYC
+        self.assertEqual(regions.locate(40.73, -74.05),
+                         {"borough": None, "neighborhood": None})
+        self.assertEqual(regions.locate(40.75, -73.70),
+                         {"borough": None, "neighborhood": None})
+
+    def test_rtree_point_query(self):
+        """Test that the R-tree returns exactly the boxes containing a point."""
+        from regions import RTree
+
+        entries = [((x, y, x + 1, y + 1), (x, y)) for x in range(20) for y in range(20)]
+        tree = RTree(entries, node_size=4)
+        self.assertEqual(sorted(tree.query_point(5.5, 7.5)), [(5, 7)])
+        self.assertEqual(sorted(tree.query_point(5, 7)), [(4, 6), (4, 7), (5, 6), (5, 7)])
+        self.assertEqual(list(tree.query_point(-3, 7)), [])
+
+    def test_backfill_regions(self):
+        """Test that untagged sandwiches are tagged in bulk."""
+        import regions
+
+        collection = MagicMock()
+        collection.find.return_value = [
+            {"_id": 1, "lat": 40.755, "lon": -73.978},
+            {"_id": 2, "lat": 40.714, "lon": -73.961},
+            {"_id": 3, "lat": 40.73, "lon": -74.05},
+        ]
+
+        regions.backfill(collection, batch_size=2)
+
+        self.assertEqual(collection.find.call_args[0][0], {"borough": {"$exists": False}})
+        batches = [call[0][0] for call in collection.bulk_write.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(batches[0][1]._doc,
+                         {"$set": {"borough": "Brooklyn",
+                                   "neighborhood": "North Side-South Side"}})
+
+    def test_retag_regions_when_region_files_change(self):
+        """Test that changed region files retag stored sandwiches once."""
+        import regions
+
+        collection = MagicMock()
+        collection.find.return_value = [
+            {"_id": 1, "lat": 40.714, "lon": -73.961, "borough": "Brooklyn",
+             "neighborhood": "North Side-South Side", "geohash": "dr5rtw"},
+            {"_id": 2, "lat": 40.714, "lon": -73.961, "borough": None,
+             "neighborhood": None, "geohash": "dr5rtw"},
+            {"_id": 3, "lat": 40.755, "lon": -73.978},
+        ]
+        meta = MagicMock()
+        meta.find_one.return_value = {"_id": "regions", "version": "old"}
+
+        self.assertEqual(regions.sync_tags(collection, meta), 2)
+
+        updates = collection.bulk_write.call_args[0][0]
+        self.assertEqual([update._filter for update in updates], [
+            {"_id": 2, "borough": None, "geohash": "dr5rtw"},
+            {"_id": 3, "borough": None, "geohash": None}
+        ])
+        self.assertEqual(updates[0]._doc,
+                         {"$set": {"borough": "Brooklyn",
+                                   "neighborhood": "North Side-South Side"}})
+        meta.update_one.assert_called_once_with(
+            {"_id": "regions"}, {"$set": {"version": regions.VERSION}}, upsert=True)
+
+        # Same files as last time, so only untagged sandwiches are looked at
+        collection.reset_mock()
+        meta.find_one.return_value = {"_id": "regions", "version": regions.VERSION}
+        collection.find.return_value = []
+        self.assertIsNone(regions.sync_tags(collection, meta))
+        self.assertEqual(collection.find.call_args[0][0], {"borough": {"$exists": False}})
+
+    def test_get_sandwiches_by_region(self):
+        """Test borough and neighborhood filters on the sandwiches API."""
+        self.mock_collection.find.return_value = []
+
+        response = self.client.get('/api/sandwiches?borough=Brooklyn&neighborhood=Williamsburg'
+                                   '&max_price=7')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.mock_collection.find.call_args[0][0], {
+            "price": {"$lte": 7.0},
+            "borough": "Brooklyn",
+            "neighborhood": "Williamsburg"
+        })
+
+    def test_price_snapshot_keeps_newest_per_location(self):
+        """Test that the snapshot grows and keeps one current price per location."""
+        from snapshot import PriceSnapshot
+
+        earlier = datetime.datetime(2025, 1, 1)
+        later = datetime.datetime(2025, 2, 1)
+        snapshot = PriceSnapshot(lambda: [], initial_capacity=2)
+        snapshot.ensure_loaded()
+        for i in range(5):
+            snapshot.add({"lat": 40.7 + i / 100, "lon": -74.0, "price": 5.0,
+                          "last_updated": earlier})
+        snapshot.add({"lat": 40.7, "lon": -74.0, "price": 9.0, "last_updated": later})
+        snapshot.add({"lat": 40.7, "lon": -74.0, "price": 1.0, "last_updated": earlier})
+
+        lat, _, price, _ = snapshot.columns()
+        self.assertEqual(len(snapshot), 5)
+        self.assertEqual(price[0], 9.0)
+        self.assertAlmostEqual(lat[4], 40.74)
+
+    def test_heatmap_api(self):
+        """Test the heatmap endpoint aggregates the snapshot per grid cell."""
+        from snapshot import PriceSnapshot
+
+        sandwiches = [
+            {"lat": 40.7001, "lon": -74.0001, "price": 5.0},
+            {"lat": 40.7002, "lon": -74.0002, "price": 6.0},
+            {"lat": 40.7003, "lon": -74.0003, "price": 10.0},
+            {"lat": 40.7500, "lon": -73.9800, "price": 7.0},
+            {"lat": 41.5000, "lon": -73.9800, "price": 7.0},
+        ]
+        snapshot = PriceSnapshot(lambda: sandwiches)
+        with patch.object(self.app_module, 'SNAPSHOT', snapshot), \
+                patch.object(self.app_module.WATCHER, 'ensure_started'):
+            response = self.client.get('/api/heatmap?cell_m=1000')
+            self.assertEqual(response.status_code, 200)
+            cells = response.get_json()["cells"]
+            self.assertEqual(cells["count"], [3, 1])
+            self.assertEqual(cells["median"], [6.0, 7.0])
+            self.assertEqual(cells["mean"], [7.0, 7.0])
+
+            # Same grid again comes from the cache
+            self.assertIs(snapshot.heatmap(1000.0), snapshot.heatmap(1000.0))
+
+            response = self.client.get('/api/heatmap?cell_m=1000&bbox=-74.01,40.69,-73.99,40.71')
+            self.assertEqual(response.get_json()["cells"]["count"], [3])
+
+            self.assertEqual(self.client.get('/api/heatmap?cell_m=10').status_code, 400)
+            self.assertEqual(self.client.get('/api/heatmap?bbox=1,2,3').status_code, 400)
+            self.assertEqual(self.client.get('/api/heatmap?bbox=-73,40,-74,41').status_code, 400)
+            for query in ('cell_m=nan', 'cell_m=inf', 'bbox=nan,40,-73,41',
+                          'bbox=-inf,40,-73,41'):
+                self.assertEqual(self.client.get(f'/api/heatmap?{query}').status_code, 400)
+
+    def test_snapshot_loads_after_change_stream_opens(self):
+        """Test that the snapshot waits for the change stream and refreshes without one."""
+        from snapshot import PriceSnapshot, SnapshotUnavailable
+
+        watcher = MagicMock()
+        watcher.unsupported = False
+        watcher.staleness.return_value = float("inf")
+        loads = []
+
+        def load():
+            loads.append(watcher.staleness())
+            return [{"lat": 40.7, "lon": -74.0, "price": 5.0}]
+
+        snapshot = PriceSnapshot(load, watcher, load_timeout=0.1, refresh_s=0)
+        with self.assertRaises(SnapshotUnavailable):
+            snapshot.ensure_loaded()
+        self.assertEqual(loads, [])
+        watcher.ensure_started.assert_called()
+
+        watcher.staleness.return_value = 0.5
+        snapshot.ensure_loaded()
+        snapshot.ensure_loaded()
+        self.assertEqual(loads, [0.5])
+        self.assertEqual(len(snapshot), 1)
+
+        # An update or delete makes the next use reload
+        snapshot.invalidate()
+        snapshot.ensure_loaded()
+        self.assertEqual(loads, [0.5, 0.5])
+        self.assertEqual(len(snapshot), 1)
+
+        # Standalone servers have no change stream, so the snapshot is reloaded
+        watcher.unsupported = True
+        watcher.staleness.return_value = float("inf")
+        snapshot.ensure_loaded()
+        self.assertEqual(len(loads), 3)
+        self.assertEqual(len(snapshot), 1)
+
+        with patch.object(self.app_module, 'SNAPSHOT',
+                          PriceSnapshot(load, MagicMock(**{"staleness.return_value": float("inf"),
+                                                           "unsupported": False}),
+                                        load_timeout=0)):
+            response = self.client.get('/api/heatmap')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers["Retry-After"], "1")
+
+    def test_tdigest_quantiles_and_merge(self):
+        """Test that merged, serialized t-digests stay close to exact quantiles."""
+        import random
+        from stats import TDigest
+
+        rng = random.Random(7)
+        values = [rng.lognormvariate(1.9, 0.2) for _ in range(20000)]
+        digests = []
+        for start in range(0, len(values), 5000):
+            digest = TDigest()
+            for value in values[start:start + 5000]:
+                digest.add(value)
+            digests.append(TDigest.from_dict(digest.to_dict()))
+
+        merged = TDigest()
+        for digest in digests:
+            merged.merge(digest)
+
+        values.sort()
+        self.assertEqual(merged.count, 20000)
+        self.assertLess(len(merged.means), 100)
+        for q in (0.1, 0.5, 0.9, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(merged.quantile(q), exact, delta=exact * 0.01)
+        self.assertIsNone(TDigest().quantile(0.5))
+
+    def test_stats_api_merges_workers(self):
+        """Test that /api/stats merges every worker's sketches for the regions asked for."""
+        from stats import PriceStats
+
+        stored = {}
+        collection = MagicMock()
+
+        def bulk_write(writes, ordered):
+            for write in writes:
+                stored[write._filter["_id"]] = {"_id": write._filter["_id"], **write._doc}
+
+        def find(query, projection):
+            return [doc for doc in stored.values() if doc["region"] in query["region"]["$in"]
+                    and doc["bucket"] >= query.get("bucket", {}).get("$gte", doc["bucket"])]
+
+        collection.bulk_write.side_effect = bulk_write
+        collection.find.side_effect = find
+
+        day = datetime.datetime(2025, 5, 1, 12)
+        workers = [PriceStats(lambda: collection, worker_id=f"w{i}",
+                              flush_interval=float("inf")) for i in range(2)]
+        for i, price in enumerate([5.0, 6.0, 7.0, 8.0]):
+            workers[i % 2].record({"price": price, "last_updated": day,
+                                   "borough": "Brooklyn", "neighborhood": "Williamsburg"})
+        workers[0].record({"price": 20.0, "last_updated": day, "borough": "Queens"})
+        workers[0].flush()
+        workers[1].flush()
+        collection.bulk_write.reset_mock()
+
+        with patch.object(self.app_module, 'STATS', workers[0]):
+            response = self.client.get('/api/stats?region=Brooklyn&from=2025-05-01&q=0.5')
+            data = response.get_json()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data["count"], 4)
+            self.assertEqual(data["mean"], 6.5)
+            self.assertEqual(data["min"], 5.0)
+            self.assertEqual(data["quantiles"], {"0.5": 6.5})
+
+            data = self.client.get('/api/stats').get_json()
+            self.assertEqual(data["count"], 5)
+
+            data = self.client.get('/api/stats?region=Brooklyn&from=2025-06-01').get_json()
+            self.assertEqual(data["count"], 0)
+            self.assertIsNone(data["quantiles"]["0.5"])
+
+            self.assertEqual(self.client.get('/api/stats?from=yesterday').status_code, 400)
+            self.assertEqual(self.client.get('/api/stats?q=2').status_code, 400)
+
+        # Reads never write
+        collection.bulk_write.assert_not_called()
+
+    def test_stats_compaction_merges_old_days(self):
+        """Test that old days end up as one sketch per region, also after a crash."""
+        import operator
+        from pymongo.errors import AutoReconnect, DuplicateKeyError
+        from stats import PriceStats
+
+        stored = {}
+        collection = MagicMock()
+        operators = {"$in": lambda value, operand: value in operand, "$ne": operator.ne,
+                     "$lt": operator.lt, "$lte": operator.le, "$gte": operator.ge}
+
+        def matches(doc, query):
+            for field, condition in query.items():
+                value = doc.get(field)
+                if not isinstance(condition, dict):
+                    if value != condition:
+                        return False
+                    continue
+                for name, operand in condition.items():
+                    if value is None and name != "$ne":
+                        return False
+                    if not operators[name](value, operand):
+                        return False
+            return True
+
+        def find_one_and_update(query, update, upsert):
+            if query["_id"] in stored:
+                if not matches(stored[query["_id"]], query):
+                    raise DuplicateKeyError("lease is taken")
+            stored[query["_id"]] = {"_id": query["_id"], **update["$set"]}
+
+        def replace_one(query, doc, upsert=False):
+            stored[query["_id"]] = {"_id": query["_id"], **doc}
+
+        collection.bulk_write.side_effect = lambda writes, ordered: [
+            replace_one(write._filter, write._doc) for write in writes]
+        collection.find.side_effect = lambda query, projection: [
+            doc for doc in list(stored.values()) if matches(doc, query)]
+        collection.find_one.side_effect = lambda query: stored.get(query["_id"])
+        collection.find_one_and_update.side_effect = find_one_and_update
+        collection.replace_one.side_effect = replace_one
+        collection.delete_many.side_effect = lambda query: [
+            stored.pop(key) for key in list(stored) if key in query["_id"]["$in"]]
+        collection.delete_one.side_effect = lambda query: stored.pop(query["_id"], None)
+
+        old_day = datetime.datetime(2025, 5, 1, 12)
+        for i, price in enumerate([5.0, 6.0, 7.0]):
+            worker = PriceStats(lambda: collection, worker_id=f"w{i}",
+                                flush_interval=float("inf"))
+            worker.record({"price": price, "last_updated": old_day, "borough": "Queens"})
+            worker.record({"price": 9.0, "last_updated": datetime.datetime.now(),
+                           "borough": "Queens"})
+            worker.flush()
+        self.assertEqual(len(stored), 12)
+
+        # Another worker is compacting
+        lease_expires = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        stored["compaction-lease"] = {"_id": "compaction-lease", "expires": lease_expires}
+        self.assertIsNone(worker.compact())
+        del stored["compaction-lease"]
+
+        # A crash after writing the compacted sketch but before the deletes
+        collection.delete_many.side_effect = None
+        self.assertEqual(worker.compact(), 2)
+        self.assertEqual(worker.query(["Queens"]).count, 6)
+
+        collection.delete_many.side_effect = lambda query: [
+            stored.pop(key) for key in list(stored) if key in query["_id"]["$in"]]
+        self.assertEqual(worker.compact(), 2)
+        old = [doc for doc in stored.values() if doc.get("bucket") == datetime.datetime(2025, 5, 1)]
+        self.assertEqual([doc["worker"] for doc in old], ["compacted", "compacted"])
+        self.assertEqual(len(stored), 8)
+        self.assertEqual(worker.query(["Queens"]).count, 6)
+        self.assertEqual(worker.query(["Queens"], start=old_day, end=old_day).count, 3)
+        self.assertNotIn("compaction-lease", stored)
+
+        # A late price whose flush fails until its day has been compacted again
+        save = collection.bulk_write.side_effect
+        collection.bulk_write.side_effect = AutoReconnect("primary stepped down")
+        worker.record({"price": 11.0, "last_updated": old_day, "borough": "Queens"})
+        with self.assertRaises(AutoReconnect):
+            worker.flush()
+        collection.bulk_write.side_effect = save
+        worker.flush()
+        self.assertEqual(worker.query(["Queens"], start=old_day, end=old_day).count, 4)
+        worker.compact()
+        self.assertEqual(worker.query(["Queens"], start=old_day, end=old_day).count, 4)
+
+        # One that was saved even though the write reported an error
+        def save_then_fail(writes, ordered):
+            save(writes, ordered)
+            raise AutoReconnect("connection closed")
+
+        collection.bulk_write.side_effect = save_then_fail
+        worker.record({"price": 12.0, "last_updated": old_day, "borough": "Queens"})
+        with self.assertRaises(AutoReconnect):
+            worker.flush()
+        worker.compact()
+        collection.bulk_write.side_effect = save
+        worker.flush()
+        worker.compact()
+        self.assertEqual(worker.query(["Queens"], start=old_day, end=old_day).count, 5)
+
+        # Recording only touches memory and leaves saving to a background thread
+        collection.bulk_write.reset_mock()
+        background = PriceStats(lambda: collection, flush_interval=60)
+        background.record({"price": 5.0, "last_updated": old_day})
+        collection.bulk_write.assert_not_called()
+        self.assertTrue(background._thread.is_alive())
+
+    def test_nearby_batch_api(self):
+        """Test batched nearby lookups share one query and sort by haversine distance."""
+        self.mock_collection.find.return_value = [dict(s) for s in self.test_sandwiches]
+
+        response = self.client.post('/api/sandwiches/nearby/batch', json={"points": [
+            {"lat": 40.7200, "lon": -74.0100, "radius": 1.5},
+            {"lat": 40.7400, "lon": -74.0300, "radius": 0.5},
+            {"lat": 41.0, "lon": -73.0},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        self.mock_collection.find.assert_called_once()
+        self.assertEqual(len(self.mock_collection.find.call_args[0][0]["$or"]), 3)
+        results = response.get_json()["results"]
+        self.assertEqual([s["name"] for s in results[0]],
+                         ["Test Deli 2", "Test Deli 1", "Test Deli 3"])
+        self.assertEqual(results[0][0]["distance"], 0)
+        # 40.7128,-74.0060 to 40.72,-74.01 is about 0.87 km along the great circle
+        self.assertAlmostEqual(results[0][1]["distance"], 0.87, places=2)
+        self.assertEqual([s["name"] for s in results[1]], ["Test Deli 4"])
+        self.assertEqual(results[2], [])
+
+    def test_nearby_batch_api_validation(self):
+        """Test that bad batch requests are rejected."""
+        self.assertEqual(self.client.post('/api/sandwiches/nearby/batch',
+                                          json={}).status_code, 400)
+        self.assertEqual(self.client.post('/api/sandwiches/nearby/batch', json={
+            "points": [{"lat": "north", "lon": -74.0}]
+        }).status_code, 400)
+        self.assertEqual(self.client.post('/api/sandwiches/nearby/batch', json={
+            "points": [{"lat": 40.7, "lon": -74.0}] * 501
+        }).status_code, 400)
+        for body in ([{"lat": 40.7, "lon": -74.0}], "points", 42, None):
+            self.assertEqual(self.client.post('/api/sandwiches/nearby/batch',
+                                              json=body).status_code, 400)
+        self.assertEqual(self.client.post('/api/sandwiches/nearby/batch', json={
+            "points": ["40.7,-74.0"]
+        }).status_code, 400)
+
+    def test_spatial_index_matches_mongo_queries(self):
+        """Test that the spatial index answers box, price and region queries itself."""
+        from spatial_index import SpatialIndex
+
+        watcher = MagicMock()
+        watcher.staleness.return_value = 0.5
+        stored = [dict(s, _id=i, borough="Manhattan") for i, s in enumerate(self.test_sandwiches)]
+        index = SpatialIndex(lambda: stored, watcher, initial_capacity=2)
+        self.assertIsNone(index.find({}))
+
+        index.load()
+        # The change stream and the insert path both report the same document
+        index.add(stored[0])
+        index.add({"_id": 99, "name": "Uptown", "address": "1 Main St", "lat": 40.80,
+                   "lon": -73.95, "price": 4.0, "borough": "Manhattan"})
+        self.assertEqual(len(index), 5)
+
+        results = index.find({"lat": {"$gt": 40.7, "$lt": 40.75},
+                              "lon": {"$gt": -74.02, "$lt": -74.0}})
+        self.assertEqual([s["name"] for s in results], ["Test Deli 1", "Test Deli 2"])
+        self.assertNotIn("_id", results[0])
+
+        results = index.find({"price": {"$gte": 6, "$lte": 7.5}, "borough": "Manhattan"})
+        self.assertEqual([s["price"] for s in results], [6.5, 7.25])
+        self.assertEqual(index.find({"borough": "Queens"}), [])
+        self.assertIsNone(index.find({"name": "Test Deli 1"}))
+        self.assertIsNone(index.find({"$or": []}))
+
+        watcher.staleness.return_value = 30
+        self.assertIsNone(index.find({}))
+        self.assertFalse(index.status()["serving"])
+
+    def test_spatial_index_reloads_after_updates(self):
+        """Test that updates and deletes make the spatial index reload from MongoDB."""
+        import time
+        from pymongo.errors import OperationFailure
+        from live_updates import ChangeStreamWatcher
+        from spatial_index import SpatialIndex
+
+        changes = MagicMock()
+        changes.alive = True
+        changes.try_next.side_effect = [
+            {"operationType": "insert", "fullDocument": {"price": 5.0},
+             "clusterTime": MagicMock(time=1)},
+            {"operationType": "update", "clusterTime": MagicMock(time=2)},
+            {"operationType": "delete", "clusterTime": MagicMock(time=3)},
+            OperationFailure("not a replica set", code=40573)
+        ]
+        collection = MagicMock()
+        collection.watch.return_value.__enter__.return_value = changes
+        watcher = ChangeStreamWatcher(lambda: collection)
+        inserted, changed = [], []
+        watcher.add_listener(inserted.append)
+        watcher.add_change_listener(lambda: changed.append(True))
+        watcher._run()
+        self.assertEqual(inserted, [{"price": 5.0}])
+        self.assertEqual(changed, [True, True])
+
+        watcher = MagicMock()
+        watcher.staleness.return_value = 0.5
+        stored = [dict(s, _id=i) for i, s in enumerate(self.test_sandwiches)]
+        index = SpatialIndex(lambda: list(stored), watcher)
+        index.invalidate()
+        self.assertFalse(index.loaded)
+
+        index.ensure_started()
+        index._thread.join(5)
+        self.assertEqual(len(index), 4)
+
+        stored[0] = dict(stored[0], price=1.0)
+        del stored[3]
+        index.invalidate()
+        deadline = time.monotonic() + 5
+        while not index.loaded and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(s["price"] for s in index.find({})), [1.0, 6.5, 7.25])
+
+        # A load that started before an invalidation adds nothing
+        self.assertFalse(index.add(stored[0], index._generation - 1))
+
+    def test_nearby_uses_spatial_index_with_fallback(self):
+        """Test that nearby lookups use a current index and go to MongoDB otherwise."""
+        from spatial_index import SpatialIndex
+
+        watcher = MagicMock()
+        watcher.staleness.return_value = 0.1
+        index = SpatialIndex(lambda: [dict(s) for s in self.test_sandwiches], watcher)
+        index.ensure_started = MagicMock()
+        index.load()
+        self.mock_collection.find.reset_mock()
+
+        with patch.object(self.app_module, 'SPATIAL_INDEX', index):
+            results = self.app_module.find_nearby_sandwiches(40.7128, -74.0060)
+            self.assertEqual(results[0]["name"], "Test Deli 1")
+            self.assertEqual(len(results), 2)
+            self.mock_collection.find.assert_not_called()
+
+            status = self.client.get('/api/spatial-index').get_json()
+            self.assertEqual(status["size"], 4)
+            self.assertTrue(status["serving"])
+
+            watcher.staleness.return_value = float("inf")
+            self.mock_collection.find.return_value = [dict(self.test_sandwiches[0])]
+            results = self.app_module.find_nearby_sandwiches(40.7128, -74.0060)
+            self.assertEqual(len(results), 1)
+            self.mock_collection.find.assert_called_once()
+            self.assertIsNone(self.client.get('/api/spatial-index').get_json()["staleness_s"])
+
+    def test_export_api_streams_parquet_and_arrow(self):
+        """Test that exports stream every chunk and honour the since watermark."""
+        import io
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.mock_collection.find.return_value = MagicMock()
+        cursor = self.mock_collection.find.return_value.sort.return_value.batch_size
+        cursor.return_value = [dict(s, _id=i) for i, s in enumerate(self.test_sandwiches)]
+
+        with patch.object(self.app_module, 'EXPORT_CHUNK_SIZE', 3), \
+                patch.object(self.app_module, 'read_collection') as secondary:
+            response = self.client.get('/api/export')
+            self.assertEqual(response.status_code, 200)
+            # Secondaries can lag by more than the settle time, so the next
+            # export's watermark would skip prices they had not seen yet
+            secondary.assert_not_called()
+            parquet = pq.ParquetFile(io.BytesIO(response.get_data()))
+            self.assertEqual(parquet.metadata.num_row_groups, 2)
+            table = parquet.read()
+            self.assertEqual(table.column("name").to_pylist()[0], "Test Deli 1")
+            self.assertEqual(table.column("id").to_pylist(), ["0", "1", "2", "3"])
+            self.assertNotIn("distance", table.column_names)
+            self.assertIn("X-Export-Watermark", response.headers)
+            cursor.assert_called_with(3)
+
+            response = self.client.get('/api/export?format=arrow&since=2025-05-01T00:00:00')
+            table = pa.ipc.open_stream(response.get_data()).read_all()
+            self.assertEqual(table.num_rows, 4)
+            query = self.mock_collection.find.call_args[0][0]
+            self.assertEqual(query["last_updated"]["$gt"], datetime.datetime(2025, 5, 1))
+
+        self.assertEqual(self.client.get('/api/export?format=csv').status_code, 400)
+        self.assertEqual(self.client.get('/api/export?since=soon').status_code, 400)
+
+    def test_export_command_saves_watermark(self):
+        """Test that the export command resumes from and advances its watermark file."""
+        import tempfile
+        import pyarrow.parquet as pq
+
+        self.mock_collection.find.return_value = MagicMock()
+        cursor = self.mock_collection.find.return_value.sort.return_value.batch_size
+        cursor.return_value = [dict(s) for s in self.test_sandwiches]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "prices.parquet")
+            watermark = os.path.join(tmp, "watermark")
+            with open(watermark, "w", encoding="utf-8") as f:
+                f.write("2025-05-01T00:00:00")
+
+            with patch.object(self.app_module, 'read_collection') as secondary:
+                result = self.app.test_cli_runner().invoke(
+                    args=["export", output, "--watermark-file", watermark])
+                secondary.assert_not_called()
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Exported 4 prices", result.output)
+            self.assertEqual(pq.read_table(output).num_rows, 4)
+
+            query = self.mock_collection.find.call_args[0][0]
+            self.assertEqual(query["last_updated"]["$gt"], datetime.datetime(2025, 5, 1))
+            with open(watermark, encoding="utf-8") as f:
+                self.assertEqual(datetime.datetime.fromisoformat(f.read()),
+                                 query["last_updated"]["$lte"])
+
+    def test_geohash_encode_and_cover(self):
+        """Test geohash encoding and that box coverings merge into contiguous ranges."""
+        import geohash
+
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geohash.encode(40.7128, -74.0060), "dr5regw3p")
+        self.assertEqual(geohash.prefix_ranges(["bz", "c0", "c1", "c3"]),
+                         [("bz", "c2"), ("c3", "c4")])
+        self.assertEqual(geohash.prefix_ranges(["zz"]), [("zz", None)])
+
+        prefixes = geohash.covering_prefixes(-74.016, 40.7028, -73.996, 40.7228)
+        self.assertLessEqual(len(prefixes), 8)
+        self.assertTrue(any(geohash.encode(40.7128, -74.0060).startswith(p) for p in prefixes))
+
+        # Boxes are clamped to the globe, and ones too big to cover get no prefixes
+        self.assertEqual(geohash.covering_prefixes(-1e5, -1e5, 1e5, 1e5), [])
+        prefixes = geohash.covering_prefixes(-1e5, 0.5, -170.5, 1)
+        self.assertTrue(prefixes)
+        self.assertTrue(all(p.startswith("8") for p in prefixes))
+
+    def test_queries_are_shard_targeted(self):
+        """Test that box queries carry borough and geohash ranges for mongos when sharded."""
+        self.mock_collection.find.return_value = []
+        self.app_module.find_nearby_sandwiches(40.7128, -74.0060)
+        self.assertNotIn("$or", self.mock_collection.find.call_args[0][0])
+
+        with patch.object(self.app_module, 'MONGO_SHARDED', True):
+            self.app_module.find_nearby_sandwiches(40.7128, -74.0060)
+            query = self.mock_collection.find.call_args[0][0]
+            self.assertEqual(query["lat"], {"$gt": 40.7028, "$lt": 40.7228})
+            boroughs = {branch["borough"] for branch in query["$or"]}
+            self.assertEqual(boroughs, {"Manhattan", "Brooklyn", None})
+            self.assertTrue(any(
+                branch["geohash"]["$gte"] <= "dr5regw3p" < branch["geohash"]["$lt"]
+                for branch in query["$or"] if branch["borough"] == "Manhattan"))
+
+            response = self.client.get(
+                '/api/sandwiches?borough=Queens&bbox=-73.95,40.70,-73.90,40.75')
+            self.assertEqual(response.status_code, 200)
+            query = self.mock_collection.find.call_args[0][0]
+            self.assertEqual(query["lon"], {"$gte": -73.95, "$lte": -73.90})
+            self.assertEqual({branch["borough"] for branch in query["$or"]}, {"Queens"})
+            self.assertEqual(self.client.get('/api/sandwiches?bbox=1,2').status_code, 400)
+
+            # Price-only filters have no shard key condition to add
+            self.client.get('/api/sandwiches?max_price=7')
+            self.assertEqual(self.mock_collection.find.call_args[0][0],
+                             {"price": {"$lte": 7.0}})
+
+            # Non-finite coordinates never reach the geohash covering
+            self.assertEqual(self.client.get(
+                '/api/sandwiches/nearby?lat=nan&lon=-74.0').status_code, 400)
+            self.assertEqual(self.client.get(
+                '/api/sandwiches/nearby?lat=40.7&lon=-74.0&radius=inf').status_code, 400)
+            self.assertEqual(self.client.post('/api/sandwiches/nearby/batch', json={
+                "points": [{"lat": "nan", "lon": -74.0}]
+            }).status_code, 400)
+            self.assertEqual(self.client.get(
+                '/api/sandwiches?bbox=nan,nan,nan,nan').status_code, 400)
+            query = {"lat": {"$gt": float("nan"), "$lt": 40.7},
+                     "lon": {"$gt": -74.0, "$lt": -73.9}}
+            self.assertIs(self.app_module.shard_target(query), query)
+
+            # Huge radii and boxes are rejected or sent untargeted, never covered cell by cell
+            self.assertEqual(self.client.get(
+                '/api/sandwiches/nearby?lat=40.7&lon=-74&radius=10000000').status_code, 400)
+            self.assertEqual(self.client.post('/api/sandwiches/nearby/batch', json={
+                "points": [{"lat": 40.7, "lon": -74.0, "radius": 10000000}]
+            }).status_code, 400)
+            self.assertEqual(self.client.get(
+                '/api/sandwiches/nearby?lat=91&lon=-74').status_code, 400)
+            self.assertEqual(self.client.get(
+                '/api/sandwiches?bbox=-100000,-100000,100000,100000').status_code, 400)
+            query = {"lat": {"$gt": -1e5, "$lt": 1e5}, "lon": {"$gt": -1e5, "$lt": 1e5}}
+            self.assertIs(self.app_module.shard_target(query), query)
+            self.client.get('/api/sandwiches?bbox=-180,-90,180,90')
+            self.assertNotIn("$or", self.mock_collection.find.call_args[0][0])
+
+        self.mock_collection.insert_one.return_value.inserted_id = "id"
+        self.client.post('/api/sandwiches', json={"name": "Deli", "address": "1 Main St",
+                                                  "price": 6, "lat": 40.7128, "lon": -74.006})
+        inserted = self.mock_collection.insert_one.call_args[0][0]
+        self.assertEqual(inserted["geohash"], "dr5regw3p")
+        self.assertEqual(inserted["borough"], "Manhattan")
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file